@@ -0,0 +1,217 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP, all_errors as ftp_errors, error_perm
+from io import BytesIO
+from threading import Lock
+from typing import io, Dict, List
+import logging
+import posixpath
+import time
+
+import requests
+
+__all__ = ['Client', 'ClientError']
+
+PACK_DIR = '.packs'  # StorageServer.PACK_DIR on the name server
+
+
+class ClientError(Exception):
+    pass
+
+
+class Client:
+    """Client of the distributed file system, which asks the name server where
+    files are stored and transfers data directly to and from storage servers.
+
+    Files which can not be transferred directly, e.g. files stored inline in
+    the directory tree, are transferred through the name server.
+
+    Arguments:
+        name_server: str - host and port of the name server
+        ftp_username: str - username of the FTP user on storage servers
+        ftp_password: str - password of the FTP user on storage servers
+        cache_size: int - how many file locations are cached
+        cache_ttl: float - how long a file location is cached, in seconds
+    """
+    def __init__(self, name_server: str, ftp_username: str, ftp_password: str,
+                 cache_size: int = 1024, cache_ttl: float = 60):
+        self.url = f'http://{name_server}/command/'
+        self.ftp_username = ftp_username
+        self.ftp_password = ftp_password
+        self.session = requests.Session()
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.locations = OrderedDict()  # (path, filename) -> (expiration time, location)
+
+    def command(self, *args: str, file: io = None) -> requests.Response:
+        """Send a command to the name server."""
+        params = {str(i): arg for i, arg in enumerate(args)}
+        if file is None:
+            response = self.session.get(self.url, params=params)
+        else:
+            response = self.session.post(self.url, params=params, files={'file': file})
+        response.raise_for_status()
+        return response
+
+    def _command_json(self, *args: str) -> Dict:
+        response = self.command(*args)
+        try:
+            return response.json()
+        except ValueError:
+            raise ClientError(response.text)
+
+    def locate(self, path: str, filename: str) -> Dict:
+        """Return location of the file, using the cache if possible."""
+        key = (path, filename)
+        cached = self.locations.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self.locations.move_to_end(key)
+            return cached[1]
+        location = self._command_json('locate', path, filename)
+        self.locations[key] = (time.monotonic() + self.cache_ttl, location)
+        self.locations.move_to_end(key)
+        while len(self.locations) > self.cache_size:
+            self.locations.popitem(last=False)
+        return location
+
+    def invalidate(self, path: str, filename: str):
+        """Remove location of the file from the cache."""
+        self.locations.pop((path, filename), None)
+
+    def read_file(self, path: str, filename: str, file: io):
+        """Read a file with the specified path."""
+        for _ in range(2):
+            location = self.locate(path, filename)
+            if not location['servers']:
+                break
+            if self._read_direct(path, filename, location, file):
+                return
+            self.invalidate(path, filename)  # the location may be stale
+        file.write(self.command('read', path, filename).content)
+        file.seek(0)
+
+    def write_file(self, path: str, filename: str, file: io):
+        """Write a file with the specified path."""
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(0)
+        self.invalidate(path, filename)
+        servers = self._command_json('allocate', path, filename, str(size))['servers']
+        written = self._write_direct(path, filename, servers, file)
+        if written:
+            answer = self.command('commit', path, filename, *written).text
+        else:
+            # the last argument of 'write' is the size, which the name server skips
+            answer = self.command('write', path, filename, str(size), file=file).text
+        if answer != 'None':
+            raise ClientError(answer)
+
+    def start_upload(self, path: str, filename: str) -> str:
+        """Start an upload session of a file with the specified path and return its id."""
+        return self._command_json('upload', path, filename)['upload']
+
+    def upload_file(self, path: str, filename: str, file: io, part_size: int = 8 * 1024 * 1024,
+                    workers: int = 4, upload: str = None):
+        """Upload a file with the specified path in parts, uploading `workers`
+        parts at once. If the upload session `upload` is given, parts which
+        are already uploaded in it are skipped, so a failed upload can be resumed."""
+        if upload is None:
+            upload = self.start_upload(path, filename)
+            uploaded = {}
+        else:
+            uploaded = self._command_json('parts', upload)['parts']
+        file.seek(0, 2)
+        size = file.tell()
+        lock = Lock()
+
+        def send(number: int, offset: int):
+            with lock:
+                file.seek(offset)
+                data = file.read(part_size)
+            if uploaded.get(str(number)) == len(data):
+                return
+            answer = self.command('part', upload, str(number), file=BytesIO(data)).text
+            if answer != 'None':
+                raise ClientError(answer)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(send, number, offset)
+                       for number, offset in enumerate(range(0, max(size, 1), part_size), start=1)]
+            for future in futures:
+                future.result()
+        self.invalidate(path, filename)
+        answer = self.command('complete', upload).text
+        if answer != 'None':
+            raise ClientError(answer)
+
+    def _connect(self, server: str) -> FTP:
+        ftp = FTP(server)
+        ftp.login(self.ftp_username, self.ftp_password)
+        return ftp
+
+    def _read_direct(self, path: str, filename: str, location: Dict, file: io) -> bool:
+        for server in location['servers']:
+            try:
+                ftp = self._connect(server)
+                try:
+                    if 'pack' in location:
+                        self._read_range(ftp, location['pack'], file)
+                    else:
+                        ftp.cwd(posixpath.join('/', path.lstrip('/')))
+                        ftp.retrbinary(f'RETR {filename}', file.write)
+                finally:
+                    ftp.close()
+            except ftp_errors as e:
+                logging.warning(f'Failed to read file {filename} from server {server}: {e}')
+                file.seek(0)
+                file.truncate()
+            else:
+                file.seek(0)
+                return True
+        return False
+
+    @staticmethod
+    def _read_range(ftp: FTP, pack: Dict, file: io):
+        if pack['length'] == 0:
+            return
+        ftp.cwd(posixpath.join('/', PACK_DIR))
+        ftp.voidcmd('TYPE I')
+        with ftp.transfercmd(f'RETR {pack["id"]}', rest=pack['offset']) as conn:
+            remaining = pack['length']
+            while remaining > 0:
+                data = conn.recv(min(remaining, 8192))
+                if not data:
+                    raise EOFError(f'Pack {pack["id"]} is shorter than expected')
+                file.write(data)
+                remaining -= len(data)
+
+    @staticmethod
+    def _make_dirs(ftp: FTP, path: str):
+        # storage servers create directories only when files are stored in them
+        ftp.cwd('/')
+        for dir_ in [dir_ for dir_ in path.split('/') if dir_]:
+            try:
+                ftp.cwd(dir_)
+            except ftp_errors:
+                try:
+                    ftp.mkd(dir_)
+                except error_perm:
+                    pass  # made by a concurrent write, cwd fails if it is not there
+                ftp.cwd(dir_)
+
+    def _write_direct(self, path: str, filename: str, servers: List[str], file: io) -> List[str]:
+        written = []
+        for server in servers:
+            try:
+                ftp = self._connect(server)
+                try:
+                    self._make_dirs(ftp, path)
+                    ftp.storbinary(f'STOR {filename}', file)
+                finally:
+                    ftp.close()
+            except ftp_errors as e:
+                logging.warning(f'Failed to write file {filename} to server {server}: {e}')
+            else:
+                written.append(server)
+            file.seek(0)
+        return written
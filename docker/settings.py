@@ -123,6 +123,16 @@ MONGO_HOST = environ.get("MONGO_HOST", "192.168.31.156:27017")
 MONGO_USER = environ.get("MONGO_USER", "admin")
 MONGO_PASSWORD = environ.get("MONGO_PASS", 'mongo')
 
+# Where directory listings and lookups of file servers are read from in a
+# replica set: primary, primaryPreferred, secondary, secondaryPreferred or
+# nearest. Reads of each client still see its own earlier writes
+MONGO_READ_PREFERENCE = environ.get("MONGO_READ_PREFERENCE", 'primary')
+
+# Engine serving the namespace: 'mongo' queries MongoDB for every operation,
+# 'memory' keeps the directory tree in memory and journals changes to MongoDB,
+# which requires a single name server process
+NAMESPACE_ENGINE = environ.get("NAMESPACE_ENGINE", 'mongo')
+
 # FTP servers
 FTP_USERNAME = environ.get("FTP_USER", 'ftpuser')
 FTP_PASSWORD = environ.get("FTP_PASS", 'ftp-pass')
@@ -130,5 +140,78 @@ FTP_PASSWORD = environ.get("FTP_PASS", 'ftp-pass')
 # Storage server port
 STORAGE_SERVER_PORT = environ.get("STORAGE_SERVER_PORT", '80')
 
+# Transport of data to storage servers: 'ftp', or 'http' to use the HTTP
+# service of storage servers on STORAGE_SERVER_PORT with keep-alive connections
+STORAGE_TRANSPORT = environ.get("STORAGE_TRANSPORT", 'ftp')
+
 # Timeout for PING request to a storage server, in seconds
 REQUEST_TIMEOUT = int(environ.get("STORAGE_REQUEST_TIMEOUT", 2))
+
+# Small files packing, sizes in bytes. Files smaller than the threshold are
+# appended to shared pack files on storage servers, 0 disables packing
+PACK_FILE_THRESHOLD = int(environ.get("PACK_FILE_THRESHOLD", 0))
+PACK_FILE_MAX_SIZE = int(environ.get("PACK_FILE_MAX_SIZE", 64 * 1024 * 1024))
+# Pack files where live data takes less than this share are rewritten on compaction
+PACK_COMPACTION_RATIO = float(environ.get("PACK_COMPACTION_RATIO", 0.5))
+
+# Files smaller than this size in bytes are stored inline in the directory
+# tree, 0 disables inline storage
+INLINE_FILE_THRESHOLD = int(environ.get("INLINE_FILE_THRESHOLD", 0))
+
+# Cache of files read from storage servers, sizes in bytes. Files evicted from
+# memory are kept in a directory on disk if FILE_CACHE_DISK_DIR is set
+FILE_CACHE_MEMORY_SIZE = int(environ.get("FILE_CACHE_MEMORY_SIZE", 64 * 1024 * 1024))
+FILE_CACHE_MAX_FILE_SIZE = int(environ.get("FILE_CACHE_MAX_FILE_SIZE", 4 * 1024 * 1024))
+FILE_CACHE_DISK_DIR = environ.get("FILE_CACHE_DISK_DIR") or None
+FILE_CACHE_DISK_SIZE = int(environ.get("FILE_CACHE_DISK_SIZE", 1024 * 1024 * 1024))
+
+# Storage servers registry, in seconds. Each process reloads the registry from
+# MongoDB after the refresh interval and pings a server only if its health was
+# checked earlier than the health check interval ago
+SERVER_REGISTRY_REFRESH_INTERVAL = float(environ.get("SERVER_REGISTRY_REFRESH_INTERVAL", 5))
+SERVER_HEALTH_CHECK_INTERVAL = float(environ.get("SERVER_HEALTH_CHECK_INTERVAL", 5))
+
+# How many files are transferred concurrently when a directory is archived or extracted
+ARCHIVE_READAHEAD = int(environ.get("ARCHIVE_READAHEAD", 4))
+
+# Scheduling of operations on each storage server: how many operations may run
+# at once, how many of them may be bulk (archives) or maintenance (clearing,
+# compaction) ones, and bandwidth limits in bytes per second, 0 means no limit
+IO_CONCURRENCY = int(environ.get("IO_CONCURRENCY", 8))
+IO_BACKGROUND_CONCURRENCY = int(environ.get("IO_BACKGROUND_CONCURRENCY", 4))
+IO_INTERACTIVE_BANDWIDTH = int(environ.get("IO_INTERACTIVE_BANDWIDTH", 0))
+IO_BULK_BANDWIDTH = int(environ.get("IO_BULK_BANDWIDTH", 0))
+IO_MAINTENANCE_BANDWIDTH = int(environ.get("IO_MAINTENANCE_BANDWIDTH", 0))
+
+# Erasure coding of files not smaller than ERASURE_FILE_THRESHOLD bytes with
+# Reed-Solomon code of ERASURE_DATA_SHARDS data and ERASURE_PARITY_SHARDS parity
+# shards instead of 2 replicas, 0 data shards disables erasure coding
+ERASURE_DATA_SHARDS = int(environ.get("ERASURE_DATA_SHARDS", 0))
+ERASURE_PARITY_SHARDS = int(environ.get("ERASURE_PARITY_SHARDS", 2))
+ERASURE_FILE_THRESHOLD = int(environ.get("ERASURE_FILE_THRESHOLD", 64 * 1024 * 1024))
+ERASURE_BLOCK_SIZE = int(environ.get("ERASURE_BLOCK_SIZE", 1024 * 1024))
+
+# How often free space of storage servers is requested from them to correct
+# the accounted one, in seconds, 0 disables it
+SPACE_RECONCILE_INTERVAL = float(environ.get("SPACE_RECONCILE_INTERVAL", 60))
+
+# Admission control of commands in each process: how many metadata and data
+# (read, write, copy, move, init, compact, uploads, archives) requests may be executed
+# at once, in total and per client, how many requests may wait for a slot and
+# for how long, in seconds
+ADMISSION_METADATA_LIMIT = int(environ.get("ADMISSION_METADATA_LIMIT", 64))
+ADMISSION_CLIENT_METADATA_LIMIT = int(environ.get("ADMISSION_CLIENT_METADATA_LIMIT", 16))
+ADMISSION_DATA_LIMIT = int(environ.get("ADMISSION_DATA_LIMIT", 16))
+ADMISSION_CLIENT_DATA_LIMIT = int(environ.get("ADMISSION_CLIENT_DATA_LIMIT", 4))
+ADMISSION_QUEUE_SIZE = int(environ.get("ADMISSION_QUEUE_SIZE", 128))
+ADMISSION_QUEUE_TIMEOUT = float(environ.get("ADMISSION_QUEUE_TIMEOUT", 5))
+
+# Watches of directories: how many long-polls may wait for changes at once, in
+# total and per client, and the longest time a long-poll waits, in seconds
+ADMISSION_WATCH_LIMIT = int(environ.get("ADMISSION_WATCH_LIMIT", 256))
+ADMISSION_CLIENT_WATCH_LIMIT = int(environ.get("ADMISSION_CLIENT_WATCH_LIMIT", 8))
+WATCH_TIMEOUT = float(environ.get("WATCH_TIMEOUT", 30))
+
+# Upload sessions not updated for this long, in seconds, are aborted and their
+# parts are deleted, 0 keeps them forever
+UPLOAD_SESSION_TIMEOUT = float(environ.get("UPLOAD_SESSION_TIMEOUT", 86400))
@@ -0,0 +1,131 @@
+from collections import Counter
+from threading import Condition
+from typing import Dict, Iterable, Iterator, Tuple
+import time
+
+METADATA = 'metadata'
+DATA = 'data'
+WATCH = 'watch'
+
+DATA_OPERATIONS = {'init', 'read', 'write', 'copy', 'move', 'compact', 'part', 'complete', 'abort'}
+
+
+def operation_kind(op: str) -> str:
+    """Return whether the operation transfers data or only works with metadata."""
+    return DATA if op in DATA_OPERATIONS else METADATA
+
+
+class Rejected(Exception):
+    """Raised when a request is not admitted, `status` is the HTTP status to respond with."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Budget:
+    def __init__(self, limit: int, client_limit: int):
+        self.limit = limit
+        self.client_limit = client_limit
+        self.condition = Condition()
+        self.active = 0
+        self.waiting = 0
+        self.clients = Counter()  # client -> requests being executed or waiting
+
+
+class AdmissionController:
+    """Limits how many requests are executed at once, separately for metadata
+    and data operations.
+
+    A client may have at most the client limit of requests of a kind being
+    executed or waiting, further requests are rejected with 429 at once.
+    When all slots of a kind are busy, requests wait for a slot for at most
+    `timeout` seconds in a queue of at most `queue_size` requests, and are
+    rejected with 503 if the queue is full or the time is out.
+
+    Arguments:
+        budgets: Dict[str, Tuple[int, int]] - limit of requests being executed
+            and limit of requests of a single client, per kind of operations
+        queue_size: int - how many requests of a kind may wait for a slot
+        timeout: float - how long a request may wait for a slot, in seconds
+    """
+    def __init__(self, budgets: Dict[str, Tuple[int, int]], queue_size: int, timeout: float):
+        self.budgets = {kind: _Budget(*limits) for kind, limits in budgets.items()}
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+    def acquire(self, client: str, kind: str):
+        """Wait for a slot to execute a request of the client, raise Rejected if
+        it can not be admitted. The slot has to be released."""
+        budget = self.budgets[kind]
+        with budget.condition:
+            if budget.clients[client] >= budget.client_limit:
+                raise Rejected(429, 'Too many concurrent requests from the client.')
+            if budget.active >= budget.limit and budget.waiting >= self.queue_size:
+                raise Rejected(503, 'The server is overloaded.')
+            budget.clients[client] += 1
+            budget.waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while budget.active >= budget.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._forget(budget, client)
+                        raise Rejected(503, 'The server is overloaded.')
+                    budget.condition.wait(remaining)
+            finally:
+                budget.waiting -= 1
+            budget.active += 1
+
+    def release(self, client: str, kind: str):
+        """Release a slot taken by `acquire`."""
+        budget = self.budgets[kind]
+        with budget.condition:
+            budget.active -= 1
+            self._forget(budget, client)
+            budget.condition.notify()
+
+    @staticmethod
+    def _forget(budget: _Budget, client: str):
+        budget.clients[client] -= 1
+        if budget.clients[client] == 0:
+            del budget.clients[client]
+
+    def admit(self, client: str, kind: str) -> '_Slot':
+        """Context manager holding a slot for a request of the client."""
+        return _Slot(self, client, kind)
+
+    def admit_streaming(self, client: str, kind: str, chunks: Iterable[bytes]) -> '_StreamingSlot':
+        """Take a slot for a streaming response and hold it until the response is closed."""
+        self.acquire(client, kind)
+        return _StreamingSlot(self, client, kind, chunks)
+
+
+class _Slot:
+    def __init__(self, controller: AdmissionController, client: str, kind: str):
+        self.controller = controller
+        self.client = client
+        self.kind = kind
+
+    def __enter__(self):
+        self.controller.acquire(self.client, self.kind)
+
+    def __exit__(self, *exc_info):
+        self.controller.release(self.client, self.kind)
+
+
+class _StreamingSlot(_Slot):
+    def __init__(self, controller: AdmissionController, client: str, kind: str, chunks: Iterable[bytes]):
+        super().__init__(controller, client, kind)
+        self.chunks = chunks
+        self.released = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.chunks)
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        if not self.released:
+            self.released = True
+            self.controller.release(self.client, self.kind)
@@ -1,3 +1,8 @@
 from .directory_tree import *
+from .memory_tree import *
+from .transport import *
 from .storage_server import *
+from .file_cache import *
+from .server_registry import *
+from .io_scheduler import *
 from .storage import *
@@ -0,0 +1,101 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from typing import io, Callable, Dict, Iterable, Iterator, Optional, Tuple
+import posixpath
+import tarfile
+import time
+
+__all__ = ['write_archive', 'read_archive', 'SPOOL_SIZE']
+
+SPOOL_SIZE = 8 * 1024 * 1024  # files larger than this are buffered on disk
+
+
+class _ChunkBuffer:
+    """Write-only file object collecting written chunks until they are taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _add_entry(tar: tarfile.TarFile, name: str, file: Optional[io], mtime: float):
+    info = tarfile.TarInfo(name)
+    info.mtime = mtime
+    if file is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+        return
+    with file:
+        file.seek(0, 2)
+        info.size = file.tell()
+        file.seek(0)
+        tar.addfile(info, file)
+
+
+def write_archive(entries: Iterable[Tuple[str, Dict]], read: Callable[[str, Dict, io], None],
+                  readahead: int) -> Iterator[bytes]:
+    """Generate a tar archive of directory tree entries chunk by chunk, without
+    buffering the whole archive.
+
+    Arguments:
+        entries - pairs of a path in the archive and a document of a directory
+            or file; directories must precede their contents
+        read - function writing content of a file into a file object, given
+            its path in the archive and its document
+        readahead: int - how many files are fetched concurrently ahead of the
+            one being written to the archive
+    """
+    def fetch(name: str, document: Dict) -> io:
+        file = SpooledTemporaryFile(SPOOL_SIZE)
+        read(name, document, file)
+        return file
+
+    buffer = _ChunkBuffer()
+    mtime = time.time()
+    tar = tarfile.open(fileobj=buffer, mode='w|')
+    with ThreadPoolExecutor(max_workers=readahead) as executor:
+        pending = deque()
+        for name, document in entries:
+            if document['type'] == 'dir':
+                pending.append((name, None))
+            else:
+                pending.append((name, executor.submit(fetch, name, document)))
+            while len(pending) > readahead:
+                name, future = pending.popleft()
+                _add_entry(tar, name, future and future.result(), mtime)
+                if buffer.chunks:
+                    yield buffer.take()
+        while pending:
+            name, future = pending.popleft()
+            _add_entry(tar, name, future and future.result(), mtime)
+            if buffer.chunks:
+                yield buffer.take()
+    tar.close()
+    yield buffer.take()
+
+
+def read_archive(file: io) -> Iterator[Tuple[str, Optional[io]]]:
+    """Read a tar archive from a stream, yielding paths of its directories and
+    files with their contents. Content of a file has to be read before the
+    next entry is taken. Entries which are neither directories nor regular
+    files, or point outside of the archive, are skipped.
+    """
+    with tarfile.open(fileobj=file, mode='r|*') as tar:
+        for member in tar:
+            name = posixpath.normpath('/' + member.name).lstrip('/')
+            if not name:
+                continue
+            if member.isdir():
+                yield name, None
+            elif member.isfile():
+                yield name, tar.extractfile(member)
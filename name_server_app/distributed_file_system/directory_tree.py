@@ -1,8 +1,26 @@
-from pymongo import MongoClient
-from typing import List, Dict
+from bson import ObjectId
+from bson.errors import InvalidId
+from collections import OrderedDict
+from contextlib import contextmanager
+from pymongo import CursorType, MongoClient, ReadPreference, ReturnDocument
+from pymongo.errors import CollectionInvalid, PyMongoError
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+import pymongo
+from typing import List, Dict, Iterator, Optional, Tuple
 import posixpath
+import threading
+import time
 
-__all__ = ['DirectoryTree', 'InvalidPathError', 'NoSuchFileError', 'NoSuchDirectoryError']
+__all__ = ['DirectoryTree', 'InvalidPathError', 'NoSuchFileError', 'NoSuchDirectoryError', 'NoSuchUploadError']
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
 
 HOST = '192.168.31.156:27017'
 USER = 'admin'
@@ -21,75 +39,265 @@ class NoSuchFileError(InvalidPathError):
     pass
 
 
+class NoSuchUploadError(InvalidPathError):
+    pass
+
+
+def stored_size(document: Dict) -> int:
+    """Return how many bytes the file takes on each of its servers as a
+    separate file. Unknown size, packed and inline files count as 0."""
+    if 'erasure' in document:
+        erasure = document['erasure']
+        stripe_size = erasure['k'] * erasure['block_size']
+        return -(-erasure['length'] // stripe_size) * erasure['block_size']
+    if 'pack' in document or 'data' in document:
+        return 0
+    return document.get('size', 0)
+
+
+def _normalize(path: str) -> str:
+    return '/'.join(dir_ for dir_ in path.split('/') if dir_)
+
+
+def _upload_id(upload_id: str) -> ObjectId:
+    try:
+        return ObjectId(upload_id)
+    except InvalidId:
+        raise NoSuchUploadError(f'There is no such upload: {upload_id}')
+
+
 class DirectoryTree:
     """Class used as client for a MongoDB storing directory tree of a
-    distributed file system.
+    distributed file system. The database is not accessed until the tree
+    is used for the first time.
+
+    Every change of the tree is also appended to a capped collection of
+    changes, which is tailed by `watch`. Changes are numbered by a counter in
+    the database, so they are ordered even when several name server processes
+    make them.
+
+    `read_dir`, `lookup_file`, `get_file_servers` and `as_list` read from
+    replica set members chosen by the read preference, other operations use
+    the primary. Inside `client_session` operations of a client are causally
+    consistent, so its reads from secondaries see its earlier writes. With
+    reads from secondaries all reads and writes use the majority read and
+    write concern, which causal consistency needs to survive a failover.
 
     Arguments:
         host: str - hostname or IP of MongoDB database
         username: str - username for MongoDB database
         password: str - password for MongoDB database
+        read_preference: str - read preference of listings and lookups, one of READ_PREFERENCES
+        client_sessions: int - for how many clients the time of the last operation is kept
     """
-    def __init__(self, host: str, username: str, password: str):
+    CHANGES_SIZE = 64 * 1024 * 1024  # the oldest changes are dropped beyond this size, in bytes
+    WATCH_RETRY_INTERVAL = 0.5  # how often an empty collection of changes is polled, in seconds
+    WATCH_GAP_TIMEOUT = 10  # a change numbered but not recorded for this long is skipped by watches, in seconds
+    WATCH_BATCH_SIZE = 1000
+    PACK_WRITE_TIMEOUT = 600  # the lease of a pack whose writer has not finished for this long expires, in seconds
+
+    def __init__(self, host: str, username: str, password: str, read_preference: str = 'primary',
+                 client_sessions: int = 10000):
         self.client = MongoClient(host=host, username=username, password=password)
-        self.db = self.client.storage
+        if READ_PREFERENCES[read_preference] == ReadPreference.PRIMARY:
+            self.db = self.client.storage
+        else:
+            self.db = self.client.get_database('storage', read_concern=ReadConcern('majority'),
+                                               write_concern=WriteConcern('majority'))
         self.tree = self.db.tree
+        self.read_tree = self.tree.with_options(read_preference=READ_PREFERENCES[read_preference])
+        self.client_sessions = client_sessions
+        self._client_times = OrderedDict()  # client -> (cluster time, operation time) of its last operation
+        self._client_times_lock = threading.Lock()
+        self._local = threading.local()
+        self.packs = self.db.packs
+        self.uploads = self.db.uploads
+        self.counters = self.db.counters
+        self._root_id = None
+        self._changes = None
 
-        if self.tree.count_documents({}) == 0:  # empty tree
-            self.root_id = self.tree.insert_one({'type': 'root'}).inserted_id
-        else:
-            self.root_id = self.tree.find_one({
-                'type': 'root'
-            })['_id']
+    @property
+    def root_id(self):
+        """Id of the root directory, which is created if the tree is empty."""
+        if self._root_id is None:
+            # the unique index makes the lookup cheap and keeps a single root
+            self.tree.create_index('type', name='root', unique=True,
+                                   partialFilterExpression={'type': 'root'})
+            self._root_id = self.tree.find_one_and_update(
+                {'type': 'root'},
+                {'$setOnInsert': {'type': 'root'}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )['_id']
+        return self._root_id
+
+    @property
+    def changes(self):
+        """Capped collection of changes in the tree, which is created on first use."""
+        if self._changes is None:
+            try:
+                self.db.create_collection('changes', capped=True, size=self.CHANGES_SIZE)
+            except CollectionInvalid:
+                pass  # created by another process
+            self.db.changes.create_index('seq')
+            self.db.changes.create_index([('dir', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)])
+            self.db.changes.create_index([('dirs', pymongo.ASCENDING), ('seq', pymongo.ASCENDING)])
+            self._changes = self.db.changes
+        return self._changes
+
+    @contextmanager
+    def client_session(self, client: str):
+        """Run operations of the client in the context in a causally consistent
+        session, which continues its previous sessions."""
+        if self.read_tree.read_preference == ReadPreference.PRIMARY:
+            yield  # reads from the primary see all writes anyway
+            return
+        with self.client.start_session(causal_consistency=True) as session:
+            with self._client_times_lock:
+                times = self._client_times.get(client)
+            if times is not None:
+                session.advance_cluster_time(times[0])
+                session.advance_operation_time(times[1])
+            self._local.session = session
+            try:
+                yield
+            finally:
+                self._local.session = None
+                if session.operation_time is not None:
+                    self._remember_client_time(client, session)
+
+    def _remember_client_time(self, client: str, session):
+        with self._client_times_lock:
+            times = self._client_times.get(client)
+            if times is None or times[1] < session.operation_time:
+                self._client_times[client] = (session.cluster_time, session.operation_time)
+            self._client_times.move_to_end(client)
+            while len(self._client_times) > self.client_sessions:
+                self._client_times.popitem(last=False)
+
+    @property
+    def _session(self):
+        """Causally consistent session of the current client, if any."""
+        return getattr(self._local, 'session', None)
+
+    def ping(self, timeout: float) -> bool:
+        """Check if the database is available and the tree is initialized."""
+        try:
+            with pymongo.timeout(timeout):
+                self.client.admin.command('ping')
+                return self.root_id is not None
+        except PyMongoError:
+            return False
 
     def clear(self):
         """Clear the directory tree."""
         self.tree.delete_many({
             'type': {'$ne': 'root'}
-        })
+        }, session=self._session)
+        self.packs.delete_many({})
+        self.uploads.delete_many({})
+        self._record_change('clear', '/', '', 'dir')
 
-    def create_file(self, path: str, filename: str, servers: List[str]):
-        """Create a file in the tree and index servers storing this file."""
-        self.tree.insert_one({
+    def create_file(self, path: str, filename: str, servers: List[str], pack: Dict = None,
+                    data: bytes = None, erasure: Dict = None, size: int = None, upload: Dict = None):
+        """Create a file in the tree and index servers storing this file.
+
+        If the file is stored in a pack file, `pack` is a dict
+        {'id': ..., 'offset': ..., 'length': ...} locating it in the pack.
+        If `data` is given, content of the file is stored inline in the tree.
+        If the file is erasure coded, `erasure` is a dict {'k': ..., 'm': ...,
+        'length': ..., 'block_size': ...} and the i-th server stores the i-th shard.
+        `size` is the size of a replicated file, in bytes.
+        If the file is made of parts of a completed upload session, `upload` is
+        a dict {'id': ..., 'parts': [{'name': ..., 'length': ...}, ...]} listing
+        the parts in order, and every server stores all of them.
+        """
+        document = self._file_document(path, filename, servers, pack, data, erasure, size, upload)
+        self.tree.insert_one(document, session=self._session)
+        self._record_change('create', path, filename, 'file')
+
+    def replace_file(self, path: str, filename: str, servers: List[str], pack: Dict = None,
+                     data: bytes = None, erasure: Dict = None, size: int = None,
+                     upload: Dict = None) -> Optional[Dict]:
+        """Create a file like `create_file`, atomically replacing the file with
+        the same name if there is one. Return the document of the replaced file,
+        or None."""
+        document = self._file_document(path, filename, servers, pack, data, erasure, size, upload)
+        document['version'] = ObjectId()  # the replacement keeps the id of the replaced document
+        replaced = self.tree.find_one_and_replace({
+            'type': 'file',
+            'name': filename,
+            'parent': document['parent'],
+        }, document, upsert=True, session=self._session)
+        self._record_change('create', path, filename, 'file')
+        return replaced
+
+    def _file_document(self, path: str, filename: str, servers: List[str], pack: Optional[Dict],
+                       data: Optional[bytes], erasure: Optional[Dict], size: Optional[int],
+                       upload: Optional[Dict]) -> Dict:
+        document = {
             'type': 'file',
             'name': filename,
             'parent': self._get_dir_id_by_path(path),
             'servers': servers,
-        })
+        }
+        if pack is not None:
+            document['pack'] = pack
+        if data is not None:
+            document['data'] = data
+        if erasure is not None:
+            document['erasure'] = erasure
+        if size is not None:
+            document['size'] = size
+        if upload is not None:
+            document['upload'] = upload
+        return document
+
+    def get_file(self, path: str, filename: str) -> Dict:
+        """Return the document of the file with the specified path."""
+        return self._get_file(path, filename, self.tree)
+
+    def lookup_file(self, path: str, filename: str) -> Dict:
+        """Return the document of the file with the specified path, read from a
+        replica set member chosen by the read preference."""
+        return self._get_file(path, filename, self.read_tree)
 
     def get_file_servers(self, path: str, filename: str) -> List[str]:
         """Return servers storing the file with the specified path"""
-        try:
-            return self.tree.find_one({
-                'type': 'file',
-                'name': filename,
-                'parent': self._get_dir_id_by_path(path),
-            })['servers']
-        except TypeError:
+        return self._get_file(path, filename, self.read_tree, {'servers': 1})['servers']
+
+    def _get_file(self, path: str, filename: str, collection, projection: Dict = None) -> Dict:
+        document = collection.find_one({
+            'type': 'file',
+            'name': filename,
+            'parent': self._get_dir_id_by_path(path, collection),
+        }, projection, session=self._session)
+        if document is None:
             raise NoSuchFileError(f'There is no such file: {posixpath.join(path, filename)}')
+        return document
 
     def delete_file(self, path: str, filename: str):
         """Delete a file from the tree."""
-        result = self.tree.delete_one({
+        document = self.tree.find_one_and_delete({
             'type': 'file',
             'name': filename,
             'parent': self._get_dir_id_by_path(path),
-        })
-        if result.deleted_count == 0:
+        }, session=self._session)
+        if document is None:
             raise NoSuchFileError(f'There is no such file: {posixpath.join(path, filename)}')
+        self._record_change('delete', path, filename, 'file')
+        if 'pack' in document:
+            self.free_pack_range(document['pack'])
 
     def copy_file(self, path: str, filename: str, new_path: str, new_filename: str = None):
         """Copy a file with the specified path to the new path."""
-        try:
-            new_filename = new_filename or filename
-            servers = self.tree.find_one({
-                'type': 'file',
-                'name': filename,
-                'parent': self._get_dir_id_by_path(path),
-            })['servers']
-            self.create_file(new_path, new_filename, servers)
-        except TypeError:
-            raise NoSuchFileError(f'There is no such file: {posixpath.join(path, filename)}')
+        new_filename = new_filename or filename
+        document = self.get_file(path, filename)
+        fields = {key: document[key] for key in ('pack', 'data', 'erasure', 'size', 'upload') if key in document}
+        self.create_file(new_path, new_filename, document['servers'], **fields)
+        if 'pack' in document:
+            self.packs.update_one({'_id': document['pack']['id']},
+                                  {'$inc': {'live': document['pack']['length']}})
 
     def move_file(self, path: str, filename: str, new_path: str, new_filename: str = None):
         """Move a file with the specified path to the new path."""
@@ -102,51 +310,397 @@ class DirectoryTree:
             'type': 'dir',
             'name': dirname,
             'parent': self._get_dir_id_by_path(path),
-        })
+        }, session=self._session)
+        self._record_change('create', path, dirname, 'dir')
 
     def read_dir(self, path: str) -> List[Dict[str, str]]:
         """Return list of files and directories stored in the directory."""
+        return self._read_dir(path, self.read_tree)
+
+    def _read_dir(self, path: str, collection) -> List[Dict[str, str]]:
         return [
             {key: document[key] for key in ('type', 'name')}
-            for document in self.tree.find({
-                 'parent': self._get_dir_id_by_path(path),
-            })
+            for document in collection.find({
+                 'parent': self._get_dir_id_by_path(path, collection),
+            }, {'type': 1, 'name': 1}, session=self._session)
         ]
 
     def delete_dir(self, path: str, dirname: str):
         """Delete a directory with the specified path."""
         self._delete_dir(posixpath.join(path, dirname))
 
+    def make_dirs(self, path: str):
+        """Make a directory with the specified path and all missing parents."""
+        cur_dir_id = self.root_id
+        cur_path = '/'
+        for dir_ in [dir_ for dir_ in path.split('/') if dir_]:
+            new_id = ObjectId()
+            cur_dir_id = self.tree.find_one_and_update(
+                {'type': 'dir', 'name': dir_, 'parent': cur_dir_id},
+                {'$setOnInsert': {'_id': new_id, 'type': 'dir', 'name': dir_, 'parent': cur_dir_id}},
+                projection={'_id': 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+                session=self._session,
+            )['_id']
+            if cur_dir_id == new_id:
+                self._record_change('create', cur_path, dir_, 'dir')
+            cur_path = posixpath.join(cur_path, dir_)
+
+    def walk(self, path: str) -> Iterator[Tuple[str, Dict]]:
+        """Yield paths relative to the directory and documents of all directories
+        and files in its subtree, level by level with one query per level."""
+        return self._walk({self._get_dir_id_by_path(path): ''})
+
+    def _walk(self, dir_paths: Dict) -> Iterator[Tuple[str, Dict]]:
+        while dir_paths:
+            documents = self.tree.find({'parent': {'$in': list(dir_paths)}}, session=self._session)
+            next_dir_paths = {}
+            for document in documents:
+                relative_path = posixpath.join(dir_paths[document['parent']], document['name'])
+                if document['type'] == 'dir':
+                    next_dir_paths[document['_id']] = relative_path
+                yield relative_path, document
+            dir_paths = next_dir_paths
+
+    def get_dir_usage(self, path: str) -> Dict[str, int]:
+        """Return servers storing files of the directory and its subdirectories
+        as separate files, i.e. servers where the directory exists, with how
+        many bytes these files take on each server."""
+        usage = {}
+        dir_ids = [self._get_dir_id_by_path(path)]
+        while dir_ids:
+            documents = list(self.tree.find({
+                'parent': {'$in': dir_ids},
+                '$or': [
+                    {'type': 'dir'},
+                    {'type': 'file', 'pack': {'$exists': False}, 'data': {'$exists': False},
+                     'upload': {'$exists': False}},
+                ],
+            }, {'type': 1, 'servers': 1, 'size': 1, 'erasure': 1}, session=self._session))
+            dir_ids = [document['_id'] for document in documents if document['type'] == 'dir']
+            for document in documents:
+                if document['type'] == 'file':
+                    for server in document['servers']:
+                        usage[server] = usage.get(server, 0) + stored_size(document)
+        return usage
+
+    def get_dir_uploads(self, path: str) -> List[Dict]:
+        """Return documents of files of the directory and its subdirectories
+        which are made of parts of completed upload sessions."""
+        uploads = []
+        dir_ids = [self._get_dir_id_by_path(path)]
+        while dir_ids:
+            documents = list(self.tree.find({
+                'parent': {'$in': dir_ids},
+                '$or': [{'type': 'dir'}, {'type': 'file', 'upload': {'$exists': True}}],
+            }, {'data': 0}, session=self._session))
+            dir_ids = [document['_id'] for document in documents if document['type'] == 'dir']
+            uploads.extend(document for document in documents if document['type'] == 'file')
+        return uploads
+
     def as_list(self) -> List[Dict[str, str]]:
         """Return directory tree as list of dicts {'path': ..., 'dirname': ...}"""
         dir_list = []
         self._traverse('/', dir_list)
         return dir_list
 
+    def watch(self, path: str, recursive: bool = False, cursor: str = None,
+              timeout: float = 30) -> Tuple[List[Dict[str, str]], str]:
+        """Wait up to `timeout` seconds for changes in the directory, or in its
+        whole subtree if `recursive`, made after the cursor.
+
+        Return the list of changes {'event': ..., 'type': ..., 'path': ...,
+        'name': ...}, where event is 'create', 'delete' or 'clear', and the
+        cursor to pass to the next call. Without a cursor only changes made
+        after the call are returned.
+
+        Changes are returned in the order of their numbers. A change numbered
+        before a recorded one may still be being recorded, so the cursor does
+        not move past it until it is recorded or WATCH_GAP_TIMEOUT passes.
+        """
+        self._get_dir_id_by_path(path)
+        dir_path = _normalize(path)
+        query = {'$or': [{'dirs' if recursive else 'dir': dir_path}, {'event': 'clear'}]}
+        try:
+            last_seq = int(cursor) if cursor else self._last_change_seq()
+        except ValueError:
+            raise InvalidPathError(f'Invalid cursor: {cursor}')
+        changes = []
+        pending = {}  # seq -> change of the directory recorded after the cursor
+        deadline = time.monotonic() + timeout
+
+        def matches(document: Dict) -> bool:
+            if document['event'] == 'clear':
+                return True
+            return dir_path in document['dirs'] if recursive else document['dir'] == dir_path
+
+        def advance():
+            nonlocal last_seq
+            while pending:
+                seq = min(pending)
+                # changes of other directories numbered before this one have to be recorded first,
+                # unless they are missing for so long that they are never going to be recorded
+                if seq != last_seq + 1 and not self._changes_recorded(last_seq, seq) and \
+                        pending[seq]['time'] >= time.time() - self.WATCH_GAP_TIMEOUT:
+                    break
+                last_seq = seq
+                changes.append(pending.pop(seq))
+
+        def take(document: Dict):
+            if document['seq'] > last_seq and matches(document):
+                pending[document['seq']] = document
+            advance()
+
+        # take changes which are already there without waiting
+        for document in self.changes.find({'seq': {'$gt': last_seq}, **query}).sort('seq', 1) \
+                .limit(self.WATCH_BATCH_SIZE):
+            take(document)
+        while not changes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            newest = self.changes.find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+            if newest is None:
+                # a tailable cursor dies at once on an empty collection
+                time.sleep(min(self.WATCH_RETRY_INTERVAL, remaining))
+                continue
+            # the newest change keeps the cursor alive until later ones are recorded
+            tail = self.changes.find({'$or': [{'_id': newest['_id']}, {'seq': {'$gt': last_seq}, **query}]},
+                                     cursor_type=CursorType.TAILABLE_AWAIT,
+                                     max_await_time_ms=int(min(remaining, self.WATCH_GAP_TIMEOUT) * 1000) + 1)
+            try:
+                while tail.alive and not changes and time.monotonic() < deadline:
+                    for document in tail:
+                        take(document)
+                        if changes:
+                            break
+                    if pending and not changes:
+                        advance()  # skip a gap which has timed out
+            finally:
+                tail.close()
+        if not changes and not pending:
+            # move the cursor past changes of other directories, so they are not scanned again
+            newest = self.changes.find_one({'seq': {'$gt': last_seq}}, sort=[('seq', -1)])
+            if newest is not None and \
+                    self.changes.count_documents({'seq': {'$gt': last_seq, '$lte': newest['seq']}, **query}) == 0 \
+                    and (self._changes_recorded(last_seq, newest['seq']) or
+                         newest['time'] < time.time() - self.WATCH_GAP_TIMEOUT):
+                last_seq = newest['seq']
+        return [
+            {'event': document['event'], 'type': document['type'],
+             'path': '/' + document['dir'], 'name': document['name']}
+            for document in changes
+        ], str(last_seq)
+
+    def _changes_recorded(self, after: int, before: int) -> bool:
+        """Whether all changes numbered between `after` and `before` are recorded."""
+        return self.changes.count_documents({'seq': {'$gt': after, '$lt': before}}) == before - after - 1
+
+    def _last_change_seq(self) -> int:
+        document = self.counters.find_one({'_id': 'changes'})
+        return document['seq'] if document is not None else 0
+
+    def _next_change_seq(self) -> int:
+        return self.counters.find_one_and_update(
+            {'_id': 'changes'},
+            {'$inc': {'seq': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )['seq']
+
+    def _change(self, event: str, path: str, name: str, type_: str) -> Dict:
+        """Return a numbered change document."""
+        dirs = [dir_ for dir_ in path.split('/') if dir_]
+        return {
+            'seq': self._next_change_seq(),
+            'time': time.time(),
+            'event': event,
+            'type': type_,
+            'dir': '/'.join(dirs),
+            'dirs': ['/'.join(dirs[:i]) for i in range(len(dirs) + 1)],  # for subtree watches
+            'name': name,
+        }
+
+    def _record_change(self, event: str, path: str, name: str, type_: str):
+        self.changes.insert_one(self._change(event, path, name, type_))
+
+    def reserve_pack_range(self, servers: List[str], length: int,
+                           max_size: int) -> Optional[Tuple[Dict, List[str]]]:
+        """Reserve `length` bytes at the end of an open pack file stored only on
+        the specified servers. Return {'id': ..., 'offset': ..., 'length': ...}
+        and servers of the pack, or None if no open pack has enough space.
+
+        The writer takes the lease of the pack, which is released with
+        `release_pack_range`. Packs are written by one writer at a time, so
+        every range is written at the end of the pack file on the servers.
+        """
+        now = time.time()
+        query = {
+            'sealed': False,
+            'size': {'$lte': max_size - length},
+            'servers': {'$not': {'$elemMatch': {'$nin': servers}}},
+            'writing': {'$not': {'$gt': now - self.PACK_WRITE_TIMEOUT}},
+        }
+        if len(servers) > 1:
+            query['servers.1'] = {'$exists': True}  # keep packs replicated
+        pack = self.packs.find_one_and_update(query, {
+            '$inc': {'size': length, 'live': length},
+            '$set': {'writing': now},
+        })
+        if pack is None:
+            return None
+        return {'id': pack['_id'], 'offset': pack['size'], 'length': length}, pack['servers']
+
+    def create_pack(self, servers: List[str], length: int) -> Dict:
+        """Create a new pack file on the specified servers, reserve `length`
+        bytes at its beginning and take its lease."""
+        pack_id = self.packs.insert_one({
+            'servers': servers,
+            'size': length,
+            'live': length,
+            'sealed': False,
+            'writing': time.time(),
+        }).inserted_id
+        return {'id': pack_id, 'offset': 0, 'length': length}
+
+    def release_pack_range(self, pack: Dict, written: bool, seal: bool = False):
+        """Release the lease of the pack taken with the reserved range. If the
+        range is not written, it is given back. If `seal`, no more files are
+        added to the pack."""
+        update = {'$set': {'writing': 0}}
+        if not written:
+            update['$inc'] = {'size': -pack['length'], 'live': -pack['length']}
+        if seal:
+            update['$set']['sealed'] = True
+        self.packs.update_one({'_id': pack['id']}, update)
+
+    def free_pack_range(self, pack: Dict):
+        """Account the range of the pack as deleted, its space is reclaimed on compaction."""
+        self.packs.update_one({'_id': pack['id']}, {'$inc': {'live': -pack['length']}})
+
+    def seal_sparse_packs(self, ratio: float) -> List[Dict]:
+        """Seal and return pack files where live data takes less than `ratio`
+        of the size, except packs being written."""
+        query = {
+            '$expr': {'$lt': ['$live', {'$multiply': ['$size', ratio]}]},
+            'writing': {'$not': {'$gt': time.time() - self.PACK_WRITE_TIMEOUT}},
+        }
+        self.packs.update_many(query, {'$set': {'sealed': True}})
+        return list(self.packs.find(query))
+
+    def get_packed_files(self, pack_id) -> List[Dict]:
+        """Return documents of files stored in the pack file."""
+        return list(self.tree.find({'type': 'file', 'pack.id': pack_id}, session=self._session))
+
+    def set_file_pack(self, file_id, servers: List[str], pack: Dict, old_pack_id) -> bool:
+        """Relocate the file from the old pack file to another one. Return False
+        if the file is not in the old pack any more, e.g. it has been replaced."""
+        result = self.tree.update_one({'_id': file_id, 'pack.id': old_pack_id},
+                                      {'$set': {'servers': servers, 'pack': pack}},
+                                      session=self._session)
+        return result.matched_count > 0
+
+    def delete_pack(self, pack_id):
+        """Delete the pack file from the index."""
+        self.packs.delete_one({'_id': pack_id})
+
+    def create_upload(self, path: str, filename: str, servers: List[str]) -> str:
+        """Start an upload session of a file with the specified path, whose parts
+        are stored on the servers, and return its id."""
+        self._get_dir_id_by_path(path)
+        return str(self.uploads.insert_one({
+            'path': path,
+            'filename': filename,
+            'servers': servers,
+            'parts': {},
+            'status': 'uploading',
+            'updated': time.time(),
+        }).inserted_id)
+
+    def get_upload(self, upload_id: str) -> Dict:
+        """Return the document of the upload session."""
+        document = self.uploads.find_one({'_id': _upload_id(upload_id)})
+        if document is None:
+            raise NoSuchUploadError(f'There is no such upload: {upload_id}')
+        return document
+
+    def set_upload_part(self, upload_id: str, number: int, part: Dict) -> Optional[Dict]:
+        """Record a part {'name': ..., 'length': ..., 'servers': ...} of the
+        upload session and return the part it replaces, if any."""
+        document = self.uploads.find_one_and_update(
+            {'_id': _upload_id(upload_id), 'status': 'uploading'},
+            {'$set': {f'parts.{number}': part, 'updated': time.time()}},
+            projection={f'parts.{number}': 1},
+        )
+        if document is None:
+            raise NoSuchUploadError(f'There is no such upload in progress: {upload_id}')
+        return document['parts'].get(str(number))
+
+    def start_completing_upload(self, upload_id: str) -> Dict:
+        """Mark the upload session as being completed, so that no more parts are
+        added to it and it is not aborted, and return its document."""
+        return self._set_upload_status(upload_id, ['uploading'], 'completing')
+
+    def stop_completing_upload(self, upload_id: str):
+        """Let parts be added to the upload session again after a failed completion."""
+        self.uploads.update_one({'_id': _upload_id(upload_id), 'status': 'completing'},
+                                {'$set': {'status': 'uploading', 'updated': time.time()}})
+
+    def start_aborting_upload(self, upload_id: str) -> Dict:
+        """Mark the upload session as being aborted, so that no more parts are
+        added to it and it is not completed, and return its document. An
+        interrupted abort may be started again."""
+        return self._set_upload_status(upload_id, ['uploading', 'aborting'], 'aborting')
+
+    def _set_upload_status(self, upload_id: str, statuses: List[str], status: str) -> Dict:
+        document = self.uploads.find_one_and_update(
+            {'_id': _upload_id(upload_id), 'status': {'$in': statuses}},
+            {'$set': {'status': status, 'updated': time.time()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if document is None:
+            raise NoSuchUploadError(f'There is no such upload in progress: {upload_id}')
+        return document
+
+    def delete_upload(self, upload_id: str, status: str) -> Optional[Dict]:
+        """Delete the upload session in the specified status and return its
+        document, or None if it is already deleted."""
+        return self.uploads.find_one_and_delete({'_id': _upload_id(upload_id), 'status': status})
+
+    def get_stale_uploads(self, before: float) -> List[str]:
+        """Return ids of upload sessions which are being uploaded or aborted and
+        were last updated before the specified time."""
+        return [str(document['_id']) for document in self.uploads.find(
+            {'status': {'$in': ['uploading', 'aborting']}, 'updated': {'$lt': before}}, {'_id': 1})]
+
     def _traverse(self, cur_path: str, dir_list: List[Dict[str, str]]):
-        for document in self.read_dir(cur_path):
+        for document in self._read_dir(cur_path, self.read_tree):
             if document['type'] == 'dir':
                 dir_list.append({'path': cur_path, 'dirname': document['name']})
                 self._traverse(posixpath.join(cur_path, document['name']), dir_list)
 
     def _delete_dir(self, path):
-        for document in self.read_dir(path):
+        for document in self._read_dir(path, self.tree):
             if document['type'] == 'dir':
                 self._delete_dir(posixpath.join(path, document['name']))
             elif document['type'] == 'file':
                 self.delete_file(path, document['name'])
-        self.tree.delete_one({'_id': self._get_dir_id_by_path(path)})
+        self.tree.delete_one({'_id': self._get_dir_id_by_path(path)}, session=self._session)
+        parent, dirname = posixpath.split(posixpath.normpath('/' + path))
+        self._record_change('delete', parent, dirname, 'dir')
 
-    def _get_dir_id_by_path(self, path: str) -> str:
+    def _get_dir_id_by_path(self, path: str, collection=None) -> str:
+        collection = self.tree if collection is None else collection
         try:
             dirs = [dir_ for dir_ in path.split('/') if dir_]
             cur_dir_id = self.root_id
             for dir_ in dirs:
-                cur_dir_id = self.tree.find_one({
+                cur_dir_id = collection.find_one({
                     'type': 'dir',
                     'name': dir_,
                     'parent': cur_dir_id
-                })['_id']
+                }, session=self._session)['_id']
             return cur_dir_id
         except TypeError:
             raise NoSuchDirectoryError(f'There is no such directory: {path}')
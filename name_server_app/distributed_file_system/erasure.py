@@ -0,0 +1,105 @@
+from typing import io, Dict, List
+import numpy as np
+
+__all__ = ['ReedSolomon']
+
+
+def _gf_tables():
+    exp = np.zeros(512, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int32)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    exp[255:510] = exp[:255]
+    mul = exp[(log[:, None] + log[None, :]) % 255]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    return exp, log, mul
+
+
+_EXP, _LOG, _MUL = _gf_tables()  # GF(2^8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1
+
+
+def _inverse(a: int) -> int:
+    return int(_EXP[255 - _LOG[a]])
+
+
+def _invert_matrix(matrix: List[List[int]]) -> List[List[int]]:
+    """Invert a square matrix over GF(2^8) by Gauss-Jordan elimination."""
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(i for i in range(col, n) if rows[i][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = _inverse(rows[col][col])
+        rows[col] = [int(_MUL[scale, value]) for value in rows[col]]
+        for i in range(n):
+            if i != col and rows[i][col]:
+                factor = rows[i][col]
+                rows[i] = [value ^ int(_MUL[factor, pivot_value])
+                           for value, pivot_value in zip(rows[i], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def _multiply(matrix: List[List[int]], shards: np.ndarray) -> np.ndarray:
+    """Multiply a matrix by shards, a 2D array with a shard in each row."""
+    result = np.zeros((len(matrix), shards.shape[1]), dtype=np.uint8)
+    for i, row in enumerate(matrix):
+        for j, coefficient in enumerate(row):
+            if coefficient:
+                result[i] ^= _MUL[coefficient].take(shards[j])
+    return result
+
+
+class ReedSolomon:
+    """Systematic Reed-Solomon code over GF(2^8) with `k` data shards and `m`
+    parity shards, any `k` of which are enough to restore the data.
+
+    Data is processed in stripes of `k` blocks of `block_size` bytes, block `i`
+    of a stripe is appended to shard `i`, and parity blocks of the stripe
+    are appended to the parity shards. Parity is computed with a Cauchy
+    matrix, so that every `k` rows of the encoding matrix are invertible.
+    """
+    def __init__(self, k: int, m: int, block_size: int):
+        if k + m > 256:
+            raise ValueError('Reed-Solomon code over GF(2^8) supports up to 256 shards.')
+        self.k = k
+        self.m = m
+        self.block_size = block_size
+        self.parity = [[_inverse((k + i) ^ j) for j in range(k)] for i in range(m)]
+        self.matrix = [[int(i == j) for j in range(k)] for i in range(k)] + self.parity
+
+    def encode(self, file: io, shards: List[io]):
+        """Read data from `file` and write `k + m` shards into `shards`."""
+        stripe_size = self.k * self.block_size
+        while True:
+            data = file.read(stripe_size)
+            if not data:
+                break
+            stripe = np.zeros(stripe_size, dtype=np.uint8)
+            stripe[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+            blocks = stripe.reshape(self.k, self.block_size)
+            for shard, block in zip(shards, np.concatenate([blocks, _multiply(self.parity, blocks)])):
+                shard.write(block.tobytes())
+            if len(data) < stripe_size:
+                break
+
+    def decode(self, shards: Dict[int, io], length: int, file: io):
+        """Restore `length` bytes of data from any `k` shards, given as a dict
+        {shard index: shard}, and write them into `file`."""
+        indexes = sorted(shards)[:self.k]
+        systematic = indexes == list(range(self.k))  # data shards only, nothing to decode
+        decoding = None if systematic else _invert_matrix([self.matrix[i] for i in indexes])
+        remaining = length
+        while remaining > 0:
+            blocks = np.stack([np.frombuffer(shards[i].read(self.block_size), dtype=np.uint8)
+                               for i in indexes])
+            if not systematic:
+                blocks = _multiply(decoding, blocks)
+            data = blocks.tobytes()[:remaining]
+            file.write(data)
+            remaining -= len(data)
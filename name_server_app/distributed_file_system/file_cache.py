@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from tempfile import mkdtemp
+from threading import Lock
+from typing import io
+import os
+import shutil
+
+__all__ = ['FileCache']
+
+
+class FileCache:
+    """LRU cache of file contents with a memory tier and an optional disk tier.
+
+    Files evicted from memory are moved to the disk tier, files read from the
+    disk tier are moved back to memory.
+
+    Arguments:
+        memory_size: int - how many bytes may be kept in memory
+        max_file_size: int - files larger than this size, in bytes, are not cached
+        disk_dir: str - directory for the disk tier, None disables the disk tier
+        disk_size: int - how many bytes may be kept on disk
+    """
+    def __init__(self, memory_size: int, max_file_size: int, disk_dir: str = None, disk_size: int = 0):
+        self.memory_size = memory_size
+        self.max_file_size = max_file_size
+        self.disk_size = disk_size if disk_dir else 0
+        self.disk_dir = mkdtemp(prefix='file-cache-', dir=disk_dir) if self.disk_size else None
+        self.memory = OrderedDict()  # key -> bytes
+        self.memory_used = 0
+        self.disk = OrderedDict()  # key -> size
+        self.disk_used = 0
+        self.lock = Lock()
+
+    def get(self, key: str, file: io) -> bool:
+        """Write the cached file into `file`. Return whether the file was cached."""
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+            elif key in self.disk:
+                data = self._pop_disk(key)
+                self._put_memory(key, data)
+        if data is None:
+            return False
+        file.write(data)
+        return True
+
+    def put(self, key: str, file: io):
+        """Cache content of `file` read from its beginning, if it is small enough."""
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(0)
+        if size > self.max_file_size or size > max(self.memory_size, self.disk_size):
+            return
+        data = file.read()
+        file.seek(0)
+        with self.lock:
+            self._remove(key)
+            self._put_memory(key, data)
+
+    def invalidate(self, key: str):
+        """Remove the file from the cache."""
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        """Remove all files from the cache."""
+        with self.lock:
+            self.memory.clear()
+            self.memory_used = 0
+            for key in list(self.disk):
+                self._pop_disk(key)
+
+    def _put_memory(self, key: str, data: bytes):
+        self.memory[key] = data
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_size:
+            evicted_key, evicted_data = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted_data)
+            self._put_disk(evicted_key, evicted_data)
+
+    def _put_disk(self, key: str, data: bytes):
+        if self.disk_dir is None or len(data) > self.disk_size:
+            return  # dropped from the cache
+        while self.disk_used + len(data) > self.disk_size:
+            self._pop_disk(next(iter(self.disk)), read=False)
+        with open(os.path.join(self.disk_dir, key), 'wb') as f:
+            f.write(data)
+        self.disk[key] = len(data)
+        self.disk_used += len(data)
+
+    def _pop_disk(self, key: str, read: bool = True) -> bytes:
+        data = None
+        path = os.path.join(self.disk_dir, key)
+        if read:
+            with open(path, 'rb') as f:
+                data = f.read()
+        os.remove(path)
+        self.disk_used -= self.disk.pop(key)
+        return data
+
+    def _remove(self, key: str):
+        if key in self.memory:
+            self.memory_used -= len(self.memory.pop(key))
+        if key in self.disk:
+            self._pop_disk(key, read=False)
+
+    def __del__(self):
+        if self.disk_dir:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+from enum import IntEnum
+from itertools import count
+from threading import Condition, Lock
+from typing import Dict
+import heapq
+import time
+
+__all__ = ['IOScheduler', 'Priority']
+
+
+class Priority(IntEnum):
+    """Priority classes of storage server operations, the lower value wins."""
+    INTERACTIVE = 0
+    BULK = 1
+    MAINTENANCE = 2
+
+
+class _TokenBucket:
+    """Token bucket limiting bandwidth to `rate` bytes per second, with bursts
+    of up to one second worth of tokens."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, size: int):
+        """Take `size` tokens, sleeping while the bucket is in debt."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _Node:
+    def __init__(self, bandwidth: Dict[Priority, int]):
+        self.condition = Condition()
+        self.active = 0
+        self.active_background = 0
+        self.waiting = []  # heap of (priority, ticket)
+        self.buckets = {priority: _TokenBucket(rate) for priority, rate in bandwidth.items() if rate > 0}
+
+
+class IOScheduler:
+    """Scheduler of operations on storage servers.
+
+    Each storage server runs at most `concurrency` operations at once, and at
+    most `background_concurrency` of them may be bulk or maintenance ones, so
+    that interactive operations always find a free slot soon. Waiting
+    operations are started in the order of priority, then arrival. Data
+    transfers of each priority class are limited to the bandwidth in bytes
+    per second given for it, 0 means no limit.
+
+    Arguments:
+        concurrency: int - how many operations may run on a server at once
+        background_concurrency: int - how many bulk and maintenance operations
+            may run on a server at once
+        bandwidth: Dict[Priority, int] - bandwidth limit on a server per priority class
+    """
+    def __init__(self, concurrency: int, background_concurrency: int, bandwidth: Dict[Priority, int]):
+        self.concurrency = concurrency
+        self.background_concurrency = background_concurrency
+        self.bandwidth = bandwidth
+        self.nodes = {}
+        self.lock = Lock()
+        self.tickets = count()
+
+    def _node(self, host: str) -> _Node:
+        with self.lock:
+            if host not in self.nodes:
+                self.nodes[host] = _Node(self.bandwidth)
+            return self.nodes[host]
+
+    def _can_start(self, node: _Node, entry) -> bool:
+        priority = entry[0]
+        if node.waiting[0] != entry or node.active >= self.concurrency:
+            return False
+        return priority == Priority.INTERACTIVE or node.active_background < self.background_concurrency
+
+    @contextmanager
+    def slot(self, host: str, priority: Priority):
+        """Wait for a free slot on the server and hold it while in the context."""
+        node = self._node(host)
+        entry = (priority, next(self.tickets))
+        background = priority != Priority.INTERACTIVE
+        with node.condition:
+            heapq.heappush(node.waiting, entry)
+            while not self._can_start(node, entry):
+                node.condition.wait()
+            heapq.heappop(node.waiting)
+            node.active += 1
+            node.active_background += background
+            node.condition.notify_all()  # the next operation may start too
+        try:
+            yield
+        finally:
+            with node.condition:
+                node.active -= 1
+                node.active_background -= background
+                node.condition.notify_all()
+
+    def throttle(self, host: str, priority: Priority, size: int):
+        """Account `size` bytes transferred to or from the server, waiting if
+        the bandwidth limit of the priority class is exceeded."""
+        bucket = self._node(host).buckets.get(priority)
+        if bucket is not None:
+            bucket.consume(size)
@@ -0,0 +1,474 @@
+from collections import defaultdict
+from threading import Condition, Event, RLock, Thread
+from typing import List, Dict, Iterator, Optional, Tuple
+import logging
+import posixpath
+import sys
+
+from bson import ObjectId
+from pymongo import DeleteMany, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .directory_tree import DirectoryTree, NoSuchDirectoryError, NoSuchFileError, stored_size
+
+__all__ = ['MemoryDirectoryTree']
+
+
+class _Node:
+    """Directory or file of the in-memory tree. Directories have dicts of
+    subdirectories and files, None while they are empty, files have servers."""
+    __slots__ = ('id', 'name', 'parent', 'dirs', 'files', 'servers', 'size', 'extra')
+
+    def __init__(self, id_, name: str, parent: Optional['_Node']):
+        self.id = id_
+        self.name = name
+        self.parent = parent
+        self.dirs = None
+        self.files = None
+        self.servers = None
+        self.size = None
+        self.extra = None  # 'pack', 'erasure' and 'upload' fields of the file document
+
+
+class _Write:
+    """Write to MongoDB and its result."""
+    __slots__ = ('collection', 'operation', 'done', 'error')
+
+    def __init__(self, collection, operation):
+        self.collection = collection
+        self.operation = operation
+        self.done = Event()
+        self.error = None
+
+
+class _Journal:
+    """Writes to MongoDB, which a background thread commits in groups: all
+    writes appended while the previous group was being committed are sent
+    in one bulk write per collection.
+
+    Every write gets its own result. If a write of a bulk write fails, the
+    writes before it are committed and the writes after it are sent again.
+    """
+
+    def __init__(self, on_failure):
+        self.on_failure = on_failure
+        self.condition = Condition()
+        self.writes = []  # appended while the previous group is committed
+        self.committing = []
+        self.thread = None
+
+    def append(self, collection, operation) -> _Write:
+        """Append a write and return it, to wait for its result."""
+        write = _Write(collection, operation)
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self._commit_forever, daemon=True)
+                self.thread.start()
+            self.writes.append(write)
+            self.condition.notify()
+        return write
+
+    def flush(self):
+        """Wait until all appended writes are committed or failed."""
+        with self.condition:
+            writes = self.committing + self.writes
+        for write in writes:
+            write.done.wait()
+
+    def _commit_forever(self):
+        while True:
+            with self.condition:
+                while not self.writes:
+                    self.condition.wait()
+                writes, self.writes = self.writes, []
+                self.committing = writes
+            groups = {}  # collection name -> writes in order
+            for write in writes:
+                groups.setdefault(write.collection.name, []).append(write)
+            failed = [write for group in groups.values() for write in self._commit(group)]
+            if failed:
+                self.on_failure()
+            with self.condition:
+                self.committing = []
+            for write in writes:
+                write.done.set()
+
+    @staticmethod
+    def _commit(writes: List[_Write]) -> List[_Write]:
+        """Commit writes to a collection in order, return the failed ones."""
+        failed = []
+        while writes:
+            try:
+                writes[0].collection.bulk_write([write.operation for write in writes])
+                break
+            except BulkWriteError as e:
+                # the writes before the failed one are committed, the ones after it are not sent
+                index = e.details['writeErrors'][0]['index']
+                logging.error(f'Failed to commit a change of the directory tree: {e}')
+                writes[index].error = e
+                failed.append(writes[index])
+                writes = writes[index + 1:]
+            except Exception as e:
+                logging.error(f'Failed to commit changes of the directory tree: {e}')
+                for write in writes:
+                    write.error = e
+                failed.extend(writes)
+                break
+        return failed
+
+
+class MemoryDirectoryTree(DirectoryTree):
+    """Directory tree kept in memory and served from it, while MongoDB stores
+    it durably.
+
+    The tree is loaded from MongoDB when it is used for the first time.
+    Lookups, `read_dir`, `as_list`, `walk` and `get_dir_usage` do not query
+    MongoDB. Changes are applied in memory and journaled to the tree
+    collection, and a change returns once its writes are committed. If a
+    write fails, the tree is loaded again once the journaled writes are
+    committed.
+    Content of inline files is not kept in memory and is read from MongoDB.
+
+    All changes of the tree have to be made through this object, so only one
+    name server process may use it.
+
+    Arguments:
+        host: str - hostname or IP of MongoDB database
+        username: str - username for MongoDB database
+        password: str - password for MongoDB database
+    """
+    DELETE_BATCH_SIZE = 10000
+
+    def __init__(self, host: str, username: str, password: str):
+        super().__init__(host, username, password)
+        self.lock = RLock()
+        self.journal = _Journal(self._invalidate)
+        self._stale = False
+        self._root = None
+        self._dirs = {}  # id -> directory
+        self._servers = {}  # interned lists of servers
+        self._change_seq = None  # number of the last change
+
+    def _invalidate(self):
+        """Mark the tree to be loaded again after a failed commit."""
+        self._stale = True  # the lock may be held by a thread waiting for the journal
+
+    @property
+    def root(self) -> _Node:
+        """Root of the tree, which is loaded from MongoDB first."""
+        with self.lock:
+            if self._root is None or self._stale:
+                self._root = self._load()
+            return self._root
+
+    def _load(self) -> _Node:
+        # writes applied in memory before the load have to be in MongoDB
+        self.journal.flush()
+        self._stale = False
+        root = _Node(self.root_id, '', None)
+        dirs = self._dirs = {root.id: root}
+        parents = []
+        for document in self.tree.find({'type': 'dir'}, {'name': 1, 'parent': 1}):
+            node = _Node(document['_id'], sys.intern(document['name']), None)
+            dirs[node.id] = node
+            parents.append((node, document['parent']))
+        for node, parent_id in parents:
+            parent = dirs.get(parent_id)
+            if parent is not None:
+                node.parent = parent
+                parent.dirs = parent.dirs or {}
+                parent.dirs[node.name] = node
+        for document in self.tree.find({'type': 'file'}, {'data': 0}):
+            parent = dirs.get(document['parent'])
+            if parent is not None:
+                self._add_file(parent, document)
+        return root
+
+    def _add_file(self, parent: _Node, document: Dict) -> _Node:
+        node = _Node(document['_id'], sys.intern(document['name']), parent)
+        node.servers = self._intern_servers(document['servers'])
+        node.size = document.get('size')
+        extra = {key: document[key] for key in ('pack', 'erasure', 'upload') if key in document}
+        node.extra = extra or None
+        parent.files = parent.files or {}
+        parent.files[node.name] = node
+        return node
+
+    def _intern_servers(self, servers: List[str]) -> Tuple[str, ...]:
+        servers = tuple(sys.intern(server) for server in servers)
+        return self._servers.setdefault(servers, servers)
+
+    def _dir_node(self, path: str) -> _Node:
+        node = self.root
+        for dir_ in [dir_ for dir_ in path.split('/') if dir_]:
+            node = (node.dirs or {}).get(dir_)
+            if node is None:
+                raise NoSuchDirectoryError(f'There is no such directory: {path}')
+        return node
+
+    def _file_node(self, path: str, filename: str) -> _Node:
+        node = (self._dir_node(path).files or {}).get(filename)
+        if node is None:
+            raise NoSuchFileError(f'There is no such file: {posixpath.join(path, filename)}')
+        return node
+
+    def _document(self, node: _Node) -> Dict:
+        if node.servers is None:
+            return {'_id': node.id, 'type': 'dir', 'name': node.name, 'parent': node.parent.id}
+        document = {
+            '_id': node.id,
+            'type': 'file',
+            'name': node.name,
+            'parent': node.parent.id,
+            'servers': list(node.servers),
+        }
+        if node.size is not None:
+            document['size'] = node.size
+        if node.extra is not None:
+            document.update(node.extra)
+        if not node.servers:
+            # only inline files are stored on no servers
+            stored = self.tree.find_one({'_id': node.id}, {'data': 1}) or {}
+            document['data'] = stored.get('data', b'')
+        return document
+
+    def _write(self, operation, collection=None) -> _Write:
+        return self.journal.append(self.tree if collection is None else collection, operation)
+
+    @staticmethod
+    def _wait(*writes: _Write):
+        for write in writes:
+            write.done.wait()
+        for write in writes:
+            if write.error is not None:
+                raise write.error
+
+    def _next_change_seq(self) -> int:
+        # changes are numbered by this process alone, the counter is only journaled
+        with self.lock:
+            if self._change_seq is None:
+                self._change_seq = self._last_change_seq()
+            self._change_seq += 1
+            self._write(UpdateOne({'_id': 'changes'}, {'$max': {'seq': self._change_seq}}, upsert=True),
+                        self.counters)
+            return self._change_seq
+
+    def _record_change(self, event: str, path: str, name: str, type_: str):
+        self._write(InsertOne(self._change(event, path, name, type_)), self.changes)
+
+    def clear(self):
+        """Clear the directory tree."""
+        with self.lock:
+            # journaled, so that it is committed after the writes before it
+            write = self._write(DeleteMany({'type': {'$ne': 'root'}}))
+            self._record_change('clear', '/', '', 'dir')
+            self._root = _Node(self.root_id, '', None)
+            self._dirs = {self._root.id: self._root}
+            self._servers = {}
+        self._wait(write)
+        self.packs.delete_many({})
+        self.uploads.delete_many({})
+
+    def create_file(self, path: str, filename: str, servers: List[str], pack: Dict = None,
+                    data: bytes = None, erasure: Dict = None, size: int = None, upload: Dict = None):
+        self.replace_file(path, filename, servers, pack, data, erasure, size, upload)
+
+    create_file.__doc__ = DirectoryTree.create_file.__doc__
+
+    def replace_file(self, path: str, filename: str, servers: List[str], pack: Dict = None,
+                     data: bytes = None, erasure: Dict = None, size: int = None,
+                     upload: Dict = None) -> Optional[Dict]:
+        document = {'_id': ObjectId(), 'type': 'file', 'name': filename, 'servers': servers}
+        for key, value in (('pack', pack), ('data', data), ('erasure', erasure), ('size', size),
+                           ('upload', upload)):
+            if value is not None:
+                document[key] = value
+        with self.lock:
+            parent = self._dir_node(path)
+            document['parent'] = parent.id
+            old = (parent.files or {}).get(filename)
+            writes = []
+            if old is not None:
+                writes.append(self._write(DeleteMany({'_id': old.id})))  # keep names unique as in memory
+            writes.append(self._write(InsertOne(document)))
+            self._add_file(parent, document)
+            self._record_change('create', path, filename, 'file')
+        self._wait(*writes)
+        return self._document(old) if old is not None else None
+
+    replace_file.__doc__ = DirectoryTree.replace_file.__doc__
+
+    def get_file(self, path: str, filename: str) -> Dict:
+        """Return the document of the file with the specified path."""
+        with self.lock:
+            node = self._file_node(path, filename)
+        return self._document(node)
+
+    def lookup_file(self, path: str, filename: str) -> Dict:
+        """Return the document of the file with the specified path."""
+        return self.get_file(path, filename)
+
+    def get_file_servers(self, path: str, filename: str) -> List[str]:
+        """Return servers storing the file with the specified path"""
+        with self.lock:
+            return list(self._file_node(path, filename).servers)
+
+    def delete_file(self, path: str, filename: str):
+        """Delete a file from the tree."""
+        with self.lock:
+            node = self._file_node(path, filename)
+            del node.parent.files[filename]
+            write = self._write(DeleteMany({'_id': node.id}))
+            self._record_change('delete', path, filename, 'file')
+        self._wait(write)
+        if node.extra is not None and 'pack' in node.extra:
+            self.free_pack_range(node.extra['pack'])
+
+    def make_dir(self, path: str, dirname: str):
+        """Make a new directory with the specified path."""
+        with self.lock:
+            parent = self._dir_node(path)
+            if dirname in (parent.dirs or {}):
+                return
+            write = self._make_dir(parent, path, dirname)
+        self._wait(write)
+
+    def _make_dir(self, parent: _Node, path: str, dirname: str) -> _Write:
+        node = _Node(ObjectId(), sys.intern(dirname), parent)
+        parent.dirs = parent.dirs or {}
+        parent.dirs[node.name] = node
+        self._dirs[node.id] = node
+        write = self._write(InsertOne({'_id': node.id, 'type': 'dir', 'name': dirname, 'parent': parent.id}))
+        self._record_change('create', path, dirname, 'dir')
+        return write
+
+    def make_dirs(self, path: str):
+        """Make a directory with the specified path and all missing parents."""
+        writes = []
+        with self.lock:
+            node = self.root
+            cur_path = '/'
+            for dir_ in [dir_ for dir_ in path.split('/') if dir_]:
+                if dir_ not in (node.dirs or {}):
+                    writes.append(self._make_dir(node, cur_path, dir_))
+                node = node.dirs[dir_]
+                cur_path = posixpath.join(cur_path, dir_)
+        self._wait(*writes)
+
+    def read_dir(self, path: str) -> List[Dict[str, str]]:
+        """Return list of files and directories stored in the directory."""
+        with self.lock:
+            node = self._dir_node(path)
+            return ([{'type': 'dir', 'name': name} for name in node.dirs or ()] +
+                    [{'type': 'file', 'name': name} for name in node.files or ()])
+
+    def _delete_dir(self, path):
+        with self.lock:
+            node = self._dir_node(path)
+            ids = []
+            packs = defaultdict(int)
+            parent_path, dirname = posixpath.split(posixpath.normpath('/' + path))
+            for dir_path, dir_node in self._subtree(parent_path, node):
+                for file in (dir_node.files or {}).values():
+                    ids.append(file.id)
+                    self._record_change('delete', dir_path, file.name, 'file')
+                    if file.extra is not None and 'pack' in file.extra:
+                        packs[file.extra['pack']['id']] += file.extra['pack']['length']
+                ids.append(dir_node.id)
+                self._dirs.pop(dir_node.id, None)
+                self._record_change('delete', posixpath.dirname(dir_path), dir_node.name, 'dir')
+            if node.parent is not None:
+                del node.parent.dirs[node.name]
+            writes = [self._write(DeleteMany({'_id': {'$in': ids[start:start + self.DELETE_BATCH_SIZE]}}))
+                      for start in range(0, len(ids), self.DELETE_BATCH_SIZE)]
+        self._wait(*writes)
+        for pack_id, length in packs.items():
+            self.packs.update_one({'_id': pack_id}, {'$inc': {'live': -length}})
+
+    def _subtree(self, parent_path: str, node: _Node) -> Iterator[Tuple[str, _Node]]:
+        """Yield paths and nodes of directories of the subtree, children first."""
+        path = posixpath.join(parent_path, node.name)
+        for child in list((node.dirs or {}).values()):
+            yield from self._subtree(path, child)
+        yield path, node
+
+    def walk(self, path: str) -> Iterator[Tuple[str, Dict]]:
+        """Yield paths relative to the directory and documents of all directories
+        and files in its subtree, level by level."""
+        with self.lock:
+            level = [('', self._dir_node(path))]
+            entries = []
+            while level:
+                next_level = []
+                for dir_path, node in level:
+                    for child in (node.dirs or {}).values():
+                        relative_path = posixpath.join(dir_path, child.name)
+                        entries.append((relative_path, child))
+                        next_level.append((relative_path, child))
+                    for child in (node.files or {}).values():
+                        entries.append((posixpath.join(dir_path, child.name), child))
+                level = next_level
+        return ((relative_path, self._document(node)) for relative_path, node in entries)
+
+    def get_dir_usage(self, path: str) -> Dict[str, int]:
+        """Return servers storing files of the directory and its subdirectories
+        as separate files, with how many bytes these files take on each server."""
+        usage = {}
+        with self.lock:
+            nodes = [self._dir_node(path)]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend((node.dirs or {}).values())
+                for file in (node.files or {}).values():
+                    if not file.servers or (file.extra is not None and ('pack' in file.extra or
+                                                                        'upload' in file.extra)):
+                        continue
+                    size = stored_size({'size': file.size or 0, **(file.extra or {})})
+                    for server in file.servers:
+                        usage[server] = usage.get(server, 0) + size
+        return usage
+
+    def get_dir_uploads(self, path: str) -> List[Dict]:
+        """Return documents of files of the directory and its subdirectories
+        which are made of parts of completed upload sessions."""
+        uploads = []
+        with self.lock:
+            nodes = [self._dir_node(path)]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend((node.dirs or {}).values())
+                uploads.extend(self._document(file) for file in (node.files or {}).values()
+                               if file.extra is not None and 'upload' in file.extra)
+        return uploads
+
+    def as_list(self) -> List[Dict[str, str]]:
+        """Return directory tree as list of dicts {'path': ..., 'dirname': ...}"""
+        dir_list = []
+        with self.lock:
+            self._traverse_nodes('/', self.root, dir_list)
+        return dir_list
+
+    def _traverse_nodes(self, cur_path: str, node: _Node, dir_list: List[Dict[str, str]]):
+        for child in (node.dirs or {}).values():
+            dir_list.append({'path': cur_path, 'dirname': child.name})
+            self._traverse_nodes(posixpath.join(cur_path, child.name), child, dir_list)
+
+    def set_file_pack(self, file_id, servers: List[str], pack: Dict, old_pack_id) -> bool:
+        """Relocate the file from the old pack file to another one. Return False
+        if the file is not in the old pack any more, e.g. it has been replaced."""
+        document = self.tree.find_one({'_id': file_id}, {'parent': 1, 'name': 1})
+        with self.lock:
+            self.root  # load the tree first
+            parent = self._dirs.get(document['parent']) if document is not None else None
+            node = (parent.files or {}).get(document['name']) if parent is not None else None
+            if node is None or node.id != file_id or (node.extra or {}).get('pack', {}).get('id') != old_pack_id:
+                return False
+            write = self._write(UpdateOne({'_id': file_id}, {'$set': {'servers': servers, 'pack': pack}}))
+            node.servers = self._intern_servers(servers)
+            node.extra = {**node.extra, 'pack': pack}
+        self._wait(write)
+        return True
+
+    def _get_dir_id_by_path(self, path: str, collection=None):
+        with self.lock:
+            return self._dir_node(path).id
@@ -0,0 +1,77 @@
+from threading import Lock
+from typing import List, Dict, Optional
+import time
+
+__all__ = ['ServerRegistry']
+
+
+class ServerRegistry:
+    """Registry of storage servers stored in a MongoDB collection, so that it is
+    shared by all name server processes and survives restarts. Each process
+    keeps a copy of the registry, which is reloaded when it gets older than
+    `refresh_interval` seconds.
+
+    Documents of the collection are {'_id': <host>, 'healthy': ..., 'checked': ...,
+    'heartbeat': ..., 'available': ...}, where 'checked' is when the health of
+    the server was last checked, 'heartbeat' is when the server was last
+    available and 'available' is how many bytes are free on the server. Free
+    space is accounted when files are written and deleted, and periodically
+    reconciled with the servers.
+
+    Arguments:
+        collection - MongoDB collection storing the registry
+        refresh_interval: float - how long the local copy is used, in seconds
+    """
+    def __init__(self, collection, refresh_interval: float):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.cache = {}
+        self.refreshed_at = float('-inf')
+        self.lock = Lock()
+
+    def refresh(self):
+        """Reload the local copy of the registry."""
+        servers = {document['_id']: document for document in self.collection.find()}
+        with self.lock:
+            self.cache = servers
+            self.refreshed_at = time.monotonic()
+
+    def _servers(self) -> Dict[str, Dict]:
+        if time.monotonic() - self.refreshed_at > self.refresh_interval:
+            self.refresh()
+        return self.cache
+
+    def servers(self) -> List[str]:
+        """Return hosts of all registered servers."""
+        return list(self._servers())
+
+    def get(self, server: str) -> Optional[Dict]:
+        """Return information about the server."""
+        return self._servers().get(server)
+
+    def add(self, server: str):
+        """Register the server, or mark it as healthy if it is registered."""
+        now = time.time()
+        self.collection.update_one({'_id': server}, {
+            '$set': {'healthy': True, 'checked': now, 'heartbeat': now},
+        }, upsert=True)
+        self.refresh()
+
+    def add_usage(self, servers: List[str], size: int):
+        """Account `size` bytes written to each of the servers, or freed on
+        them if `size` is negative."""
+        if not servers or size == 0:
+            return
+        self.collection.update_many({'_id': {'$in': servers}}, {'$inc': {'available': -size}})
+        with self.lock:
+            for server in servers:
+                if server in self.cache:
+                    info = self.cache[server]
+                    self.cache[server] = {**info, 'available': info.get('available', 0) - size}
+
+    def update(self, server: str, **fields):
+        """Update information about the server."""
+        self.collection.update_one({'_id': server}, {'$set': fields})
+        with self.lock:
+            if server in self.cache:
+                self.cache[server] = {**self.cache[server], **fields}
@@ -1,11 +1,31 @@
 import random
-from typing import io, List, Dict
-from ftplib import all_errors as ftp_errors
+from bson import ObjectId
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import io, List, Dict, Iterator, Optional, Tuple
+from ftplib import all_errors as ftp_errors  # errors of requests of the HTTP transport are OSErrors too
+from tempfile import TemporaryFile, SpooledTemporaryFile
 import logging
+import posixpath
+import shutil
 import sys
+import threading
+import time
 
-from name_server_proj.settings import MONGO_HOST, MONGO_USER, MONGO_PASSWORD, FTP_USERNAME, FTP_PASSWORD
-from .directory_tree import DirectoryTree
+from name_server_proj.settings import MONGO_HOST, MONGO_USER, MONGO_PASSWORD, FTP_USERNAME, FTP_PASSWORD, \
+    PACK_FILE_THRESHOLD, PACK_FILE_MAX_SIZE, PACK_COMPACTION_RATIO, INLINE_FILE_THRESHOLD, \
+    FILE_CACHE_MEMORY_SIZE, FILE_CACHE_MAX_FILE_SIZE, FILE_CACHE_DISK_DIR, FILE_CACHE_DISK_SIZE, \
+    SERVER_REGISTRY_REFRESH_INTERVAL, SERVER_HEALTH_CHECK_INTERVAL, REQUEST_TIMEOUT, ARCHIVE_READAHEAD, \
+    IO_CONCURRENCY, IO_BACKGROUND_CONCURRENCY, IO_INTERACTIVE_BANDWIDTH, IO_BULK_BANDWIDTH, IO_MAINTENANCE_BANDWIDTH, \
+    ERASURE_DATA_SHARDS, ERASURE_PARITY_SHARDS, ERASURE_FILE_THRESHOLD, ERASURE_BLOCK_SIZE, \
+    SPACE_RECONCILE_INTERVAL, UPLOAD_SESSION_TIMEOUT, STORAGE_TRANSPORT, NAMESPACE_ENGINE, MONGO_READ_PREFERENCE
+from .archive import write_archive, read_archive, SPOOL_SIZE
+from .directory_tree import DirectoryTree, InvalidPathError, NoSuchUploadError, stored_size
+from .memory_tree import MemoryDirectoryTree
+from .file_cache import FileCache
+from .server_registry import ServerRegistry
+from .io_scheduler import IOScheduler, Priority
+from .erasure import ReedSolomon
 from .storage_server import StorageServer
 from ..helpers import ping, request_space_available
 
@@ -13,6 +33,9 @@ __all__ = ['Storage', 'NoServersAvailable']
 
 FTP_HOSTS = ['192.168.31.157', '192.168.31.158', '192.168.31.159']
 
+REPLICAS = 2  # how many storage servers store a replicated file or a pack
+UPLOAD_CLEANUP_INTERVAL = 60  # how often abandoned upload sessions are looked for, in seconds
+
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(levelname)s: %(message)s')
 
 
@@ -20,115 +43,495 @@ class NoServersAvailable(Exception):
     pass
 
 
+def _file_size(file: io) -> int:
+    """Return size of the file object, in bytes."""
+    size = getattr(file, 'size', None)  # uploaded files know their size
+    if size is None:
+        file.seek(0, 2)
+        size = file.tell()
+        file.seek(0)
+    return size
+
+
+def _erasure_coded(length: int) -> bool:
+    """Return whether a file of the specified size is erasure coded."""
+    return ERASURE_DATA_SHARDS > 0 and length >= ERASURE_FILE_THRESHOLD
+
+
+def _stored_on_servers(document: Dict) -> bool:
+    """Return whether the file is stored as a separate file on storage servers."""
+    return 'pack' not in document and 'data' not in document and 'upload' not in document
+
+
+def _cache_key(document: Dict) -> str:
+    """Return the key of the version of the file in the file cache."""
+    # every write creates a new document or a new version of the document
+    return str(document.get('version', document['_id']))
+
+
 class Storage(object):
     """Singleton class representing storage of a distributed file system."""
 
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(Storage, cls).__new__(cls)
-            logging.info('Connecting to MongoDB.')
-            cls.instance.directory_tree = DirectoryTree(MONGO_HOST, MONGO_USER, MONGO_PASSWORD)
-            logging.info('Successfully connected to MongoDB.')
-            cls.instance.storage_servers = []
+            if NAMESPACE_ENGINE == 'memory':
+                cls.instance.directory_tree = MemoryDirectoryTree(MONGO_HOST, MONGO_USER, MONGO_PASSWORD)
+            else:
+                cls.instance.directory_tree = DirectoryTree(MONGO_HOST, MONGO_USER, MONGO_PASSWORD,
+                                                            MONGO_READ_PREFERENCE)
+            cls.instance.io_scheduler = IOScheduler(IO_CONCURRENCY, IO_BACKGROUND_CONCURRENCY, {
+                Priority.INTERACTIVE: IO_INTERACTIVE_BANDWIDTH,
+                Priority.BULK: IO_BULK_BANDWIDTH,
+                Priority.MAINTENANCE: IO_MAINTENANCE_BANDWIDTH,
+            })
+            cls.instance.server_registry = ServerRegistry(cls.instance.directory_tree.db.servers,
+                                                          SERVER_REGISTRY_REFRESH_INTERVAL)
+            cls.instance.file_cache = FileCache(FILE_CACHE_MEMORY_SIZE, FILE_CACHE_MAX_FILE_SIZE,
+                                                FILE_CACHE_DISK_DIR, FILE_CACHE_DISK_SIZE)
+            if SPACE_RECONCILE_INTERVAL > 0:
+                threading.Thread(target=cls.instance._reconcile_space_periodically, daemon=True).start()
+            if UPLOAD_SESSION_TIMEOUT > 0:
+                threading.Thread(target=cls.instance._abort_stale_uploads_periodically, daemon=True).start()
         return cls.instance
 
+    def client_session(self, client: str):
+        """Context in which metadata reads of the client see its earlier writes."""
+        return self.directory_tree.client_session(client)
+
+    def is_ready(self) -> bool:
+        """Check if the storage is ready to serve requests."""
+        return self.directory_tree.ping(REQUEST_TIMEOUT)
+
+    @property
+    def storage_servers(self) -> List[str]:
+        """Return all registered storage servers."""
+        return self.server_registry.servers()
+
     def _available_servers(self) -> List[str]:
-        """Return available servers."""
-        return [server for server in self.storage_servers if ping(server)]
+        """Return available servers.
 
-    def _choose_storage_servers(self) -> List[str]:
-        """Choose storage server for a new file."""
-        servers = self._available_servers()
+        Servers are pinged only if their health was checked more than
+        SERVER_HEALTH_CHECK_INTERVAL seconds ago.
+        """
+        servers = []
+        now = time.time()
+        for server in self.storage_servers:
+            info = self.server_registry.get(server) or {}
+            if now - info.get('checked', 0) < SERVER_HEALTH_CHECK_INTERVAL:
+                healthy = info['healthy']
+            else:
+                healthy = ping(server)
+                fields = {'healthy': healthy, 'checked': now}
+                if healthy:
+                    fields['heartbeat'] = now
+                self.server_registry.update(server, **fields)
+            if healthy:
+                servers.append(server)
+        return servers
+
+    def _connect(self, server: str, priority: Priority = Priority.INTERACTIVE) -> StorageServer:
+        """Connect to the storage server, scheduling its operations with the priority."""
+        return StorageServer(server, FTP_USERNAME, FTP_PASSWORD, self.io_scheduler, priority, STORAGE_TRANSPORT)
+
+    def _choose_storage_servers(self, servers: List[str] = None, count: int = REPLICAS, length: int = 0) -> List[str]:
+        """Choose storage server for a new file of the specified length.
+
+        Servers without enough free space are skipped, the others are chosen
+        randomly with probability proportional to their free space.
+        """
+        if servers is None:
+            servers = self._available_servers()
+        free_space = {server: (self.server_registry.get(server) or {}).get('available', 0) for server in servers}
         if len(servers) == 0:
             raise NoServersAvailable('No storage servers are available.')
-        if len(servers) > 2:
-            return random.sample(servers, 2)
+        servers = [server for server in servers if free_space[server] >= length]
+        if len(servers) == 0:
+            raise NoServersAvailable('No storage servers have enough free space.')
+        chosen = []
+        while servers and len(chosen) < count:
+            server = random.choices(servers, [max(free_space[server], 0) + 1 for server in servers])[0]
+            servers.remove(server)
+            chosen.append(server)
+        return chosen
+
+    def _reserve_pack_range(self, length: int) -> Tuple[List[str], Dict]:
+        """Choose a pack file for a small file, reserve space in it and take the
+        lease of the pack, which `_write_pack` releases."""
+        servers = self._available_servers()
+        reserved = self.directory_tree.reserve_pack_range(servers, length, PACK_FILE_MAX_SIZE)
+        if reserved is not None:
+            pack, servers = reserved
         else:
-            return servers
+            servers = self._choose_storage_servers(servers, length=length)
+            pack = self.directory_tree.create_pack(servers, length)
+        self.server_registry.add_usage(servers, length)
+        return servers, pack
 
-    def _get_file_servers(self, path: str, filename: str) -> List[str]:
-        """Return file servers storing the specified file."""
-        return self.directory_tree.get_file_servers(path, filename)
+    def _write_pack(self, servers: List[str], pack: Dict, file: io,
+                    priority: Priority = Priority.INTERACTIVE) -> List[str]:
+        """Write a small file into the reserved range of the pack file and
+        release the lease of the pack. Return servers where the file is written.
+
+        If the write fails on all servers, the range is given back. If it
+        fails on some of them, the pack is sealed, since its replicas differ.
+        """
+        written = []
+        try:
+            for server in servers:
+                try:
+                    storage_server = self._connect(server, priority)
+                    storage_server.write_pack(str(pack['id']), pack['offset'], file)
+                    written.append(server)
+                except ftp_errors as e:
+                    logging.error(f'Failed to write pack {pack["id"]} on server '
+                                  f'{server}: {e}')
+                file.seek(0)
+        finally:
+            self.directory_tree.release_pack_range(pack, written=bool(written),
+                                                   seal=0 < len(written) < len(servers))
+            self.server_registry.add_usage([server for server in servers if server not in written],
+                                           -pack['length'])
+        return written
+
+    def _read_pack(self, servers: List[str], pack: Dict, file: io,
+                   priority: Priority = Priority.INTERACTIVE) -> bool:
+        """Read a small file from the pack file. Return whether the read succeeded."""
+        for server in servers:
+            try:
+                storage_server = self._connect(server, priority)
+                storage_server.read_pack(str(pack['id']), pack['offset'], pack['length'], file)
+                file.seek(0)
+            except ftp_errors as e:
+                logging.error(f'Failed to read pack {pack["id"]} on server '
+                              f'{server}: {e}')
+            else:
+                return True
+        return False
 
     def get_available_space(self):
-        """Returns how many bytes are available in storage."""
+        """Returns how many bytes of files can be stored, as accounted in the registry.
+
+        Free space of healthy servers is divided by the redundancy of large files:
+        (k + m) / k when they are erasure coded, the number of replicas otherwise.
+        """
         total = 0
-        for server in self._available_servers():
-            total += request_space_available(server)
-        return total // 2
+        healthy = 0
+        for server in self.storage_servers:
+            info = self.server_registry.get(server) or {}
+            if info.get('healthy'):
+                healthy += 1
+                total += max(info.get('available', 0), 0)
+        if ERASURE_DATA_SHARDS > 0 and healthy >= ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS:
+            return total * ERASURE_DATA_SHARDS // (ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS)
+        return total // REPLICAS
+
+    def _reconcile_space(self, servers: List[str]):
+        """Update free space of the servers with the space reported by them.
+        Servers which do not report it keep the accounted free space."""
+        for server in servers:
+            if ping(server):
+                available = request_space_available(server)
+                if available is None:
+                    logging.error(f'Failed to get free space of server {server}')
+                    continue
+                self.server_registry.update(server, available=available)
+
+    def _reconcile_space_periodically(self):
+        while True:
+            time.sleep(SPACE_RECONCILE_INTERVAL)
+            try:
+                self._reconcile_space(self._available_servers())
+            except Exception as e:
+                logging.error(f'Failed to reconcile free space of storage servers: {e}')
 
     def clear(self):
         """Clear the storage."""
         self.directory_tree.clear()
+        self.file_cache.clear()
         for server in self.storage_servers:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server, Priority.MAINTENANCE)
                 storage_server.clear()
             except ftp_errors as e:
                 logging.error(f'Failed to clear the storage on server '
                               f'{server}: {e}')
+        self._reconcile_space(self.storage_servers)
 
     def add_storage_server(self, server: str):
         """Add storage server to the distributed file system."""
-        if server not in self.storage_servers:
-            self.storage_servers.append(server)
+        self.server_registry.add(server)
 
         try:
-            storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+            storage_server = self._connect(server, Priority.MAINTENANCE)
             storage_server.clear()
         except ftp_errors as e:
             logging.error(f'Failed to clear the storage on server '
                           f'{server}: {e}')
-
-        self.create_dirs(server)
+        self._reconcile_space([server])
 
     def create_file(self, path: str, filename: str):
         """Create an empty file with the specified path."""
+        if INLINE_FILE_THRESHOLD > 0:
+            self.directory_tree.create_file(path, filename, [], data=b'')
+            return
+
         servers = self._choose_storage_servers()
-        self.directory_tree.create_file(path, filename, servers)
+        self.directory_tree.create_file(path, filename, servers, size=0)
         for server in servers:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server)
                 storage_server.create_file(path, filename)
             except ftp_errors as e:
                 logging.error(f'Failed to create file {filename} on server '
                               f'{server}: {e}')
 
-    def write_file(self, path: str, filename: str, file: io):
-        """Write a file with the specified path."""
-        servers = self._choose_storage_servers()
-        self.directory_tree.create_file(path, filename, servers)
+    def write_file(self, path: str, filename: str, file: io, priority: Priority = Priority.INTERACTIVE):
+        """Write a file with the specified path.
+
+        The new version is written under a staging name, moved into place on
+        each server and only then replaces the previous one in the directory
+        tree, so readers never see a partly written file and the previous
+        version is kept if the write fails.
+        """
+        length = _file_size(file)
+        if length < INLINE_FILE_THRESHOLD:
+            self._replace_file(path, filename, [], data=file.read())
+            return
+        if length < PACK_FILE_THRESHOLD:
+            servers, pack = self._reserve_pack_range(length)
+            servers = self._write_pack(servers, pack, file, priority)
+            if not servers:
+                raise NoServersAvailable(f'Failed to write file {filename} on storage servers.')
+            self._replace_file(path, filename, servers, pack=pack)
+            return
+        if _erasure_coded(length):
+            servers = self._available_servers()
+            if len(servers) >= ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS:
+                servers = self._choose_storage_servers(servers, ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS)
+                self._write_erasure(path, filename, file, length, servers, priority)
+                return
+            logging.warning(f'Not enough storage servers to erasure code file {filename}, '
+                            f'it is replicated instead')
+
+        staged = str(ObjectId())
+        servers = self._choose_storage_servers(length=length)
+        written = []
         for server in servers:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
-                storage_server.write_file(path, filename, file)
-                file.seek(0)
+                storage_server = self._connect(server, priority)
+                storage_server.write_staged(staged, file)
+                written.append(server)
             except ftp_errors as e:
                 logging.error(f'Failed to write file {filename} on server '
                               f'{server}: {e}')
+            file.seek(0)
+        # failed writes may leave a part of the file
+        self._delete_staged(filename, staged, [server for server in servers if server not in written])
+        written = self._commit_staged(path, filename, staged, written, priority)
+        if not written:
+            raise NoServersAvailable(f'Failed to write file {filename} on storage servers.')
+        self._replace_file(path, filename, written, size=length)
+
+    def _commit_staged(self, path: str, filename: str, staged: str, servers: List[str],
+                       priority: Priority = Priority.INTERACTIVE) -> List[str]:
+        """Move a file written under the staging name into place on the servers.
+        Return the servers where it has been moved, it is deleted from the others."""
+        committed = []
+        for server in servers:
+            try:
+                storage_server = self._connect(server, priority)
+                storage_server.commit_staged(staged, path, filename)
+                committed.append(server)
+            except ftp_errors as e:
+                logging.error(f'Failed to move file {filename} into place on server '
+                              f'{server}: {e}')
+        self._delete_staged(filename, staged, [server for server in servers if server not in committed])
+        return committed
+
+    def _delete_staged(self, filename: str, staged: str, servers: List[str]):
+        for server in servers:
+            try:
+                storage_server = self._connect(server)
+                storage_server.delete_staged(staged)
+            except ftp_errors as e:
+                logging.error(f'Failed to delete staged file {filename} on server '
+                              f'{server}: {e}')
 
     def read_file(self, path: str, filename: str, file: io):
         """Read a file with the specified path."""
-        servers = self._get_file_servers(path, filename)
-        for server in servers:
+        self._read_document(path, self.directory_tree.lookup_file(path, filename), file)
+
+    def _read_document(self, path: str, document: Dict, file: io,
+                       priority: Priority = Priority.INTERACTIVE) -> bool:
+        """Read a file stored in the directory with the specified path.
+        Return whether it was read."""
+        filename = document['name']
+        if 'data' in document:
+            file.write(document['data'])
+            file.seek(0)
+            return True
+        cache_key = _cache_key(document)
+        if self.file_cache.get(cache_key, file):
+            file.seek(0)
+            return True
+        if 'pack' in document:
+            if self._read_pack(document['servers'], document['pack'], file, priority):
+                self.file_cache.put(cache_key, file)
+                return True
+            logging.error(f'Failed to read file {filename}')
+            return False
+        if 'erasure' in document:
+            if self._read_erasure(path, document, file, priority):
+                self.file_cache.put(cache_key, file)
+                return True
+            logging.error(f'Failed to read file {filename}')
+            return False
+        if 'upload' in document:
+            if self._read_upload(document, file, priority):
+                self.file_cache.put(cache_key, file)
+                return True
+            logging.error(f'Failed to read file {filename}')
+            return False
+
+        for server in document['servers']:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server, priority)
                 storage_server.read_file(path, filename, file)
                 file.seek(0)
             except ftp_errors as e:
                 logging.error(f'Failed to read file {filename} on server '
                               f'{server}: {e}')
             else:
-                return
+                self.file_cache.put(cache_key, file)
+                return True
         logging.error(f'Failed to read file {filename}')
+        return False
+
+    def _read_upload(self, document: Dict, file: io, priority: Priority) -> bool:
+        """Read parts of a file made of an upload session one after another, each
+        from the first server which has it. Return whether the read succeeded."""
+        upload = document['upload']
+        for part in upload['parts']:
+            start = file.tell()
+            for server in document['servers']:
+                try:
+                    storage_server = self._connect(server, priority)
+                    storage_server.read_part(upload['id'], part['name'], file)
+                    break
+                except ftp_errors as e:
+                    logging.error(f'Failed to read part {part["name"]} of file {document["name"]} on server '
+                                  f'{server}: {e}')
+                    file.seek(start)
+                    file.truncate()
+            else:
+                return False
+        file.seek(0)
+        return True
+
+    def _write_erasure(self, path: str, filename: str, file: io, length: int, servers: List[str],
+                       priority: Priority):
+        """Encode a file into shards, write the i-th shard to the i-th server
+        under a staging name and move the shards into place and record the
+        file once all of them are written."""
+        block_size = min(ERASURE_BLOCK_SIZE, -(-length // ERASURE_DATA_SHARDS))
+        codec = ReedSolomon(ERASURE_DATA_SHARDS, ERASURE_PARITY_SHARDS, block_size)
+        erasure = {
+            'k': codec.k,
+            'm': codec.m,
+            'length': length,
+            'block_size': block_size,
+        }
+        shards = [SpooledTemporaryFile(SPOOL_SIZE) for _ in servers]
+        codec.encode(file, shards)
+        staged = str(ObjectId())
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            writes = [executor.submit(self._write_shard, filename, staged, server, shard, priority)
+                      for server, shard in zip(servers, shards)]
+            written = [server for server, write in zip(servers, writes) if write.result()]
+        if len(written) < len(servers):
+            self._delete_staged(filename, staged, servers)  # failed writes may leave a part of a shard
+            raise NoServersAvailable(f'Failed to write file {filename} on storage servers.')
+        committed = self._commit_staged(path, filename, staged, servers, priority)
+        missing = [server for server in servers if server not in committed]
+        if len(committed) < codec.k:
+            # the previous version is overwritten on these servers, so it must not be read from them
+            self._delete_replicas(path, filename, committed)
+            raise NoServersAvailable(f'Failed to write file {filename} on storage servers.')
+        # a previous version left in place of a missing shard would be decoded as the shard
+        self._delete_replicas(path, filename, missing)
+        self._replace_file(path, filename, servers, erasure=erasure)
+
+    def _write_shard(self, filename: str, staged: str, server: str, shard: io, priority: Priority) -> bool:
+        with shard:
+            shard.seek(0)
+            try:
+                storage_server = self._connect(server, priority)
+                storage_server.write_staged(staged, shard)
+                return True
+            except ftp_errors as e:
+                logging.error(f'Failed to write shard of file {filename} on server '
+                              f'{server}: {e}')
+                return False
+
+    def _read_erasure(self, path: str, document: Dict, file: io, priority: Priority) -> bool:
+        """Read shards of an erasure coded file in parallel and decode them.
+        Data shards are read first, parity shards only replace failed ones.
+        Return whether the read succeeded."""
+        erasure = document['erasure']
+        codec = ReedSolomon(erasure['k'], erasure['m'], erasure['block_size'])
+        candidates = list(enumerate(document['servers']))
+        shards = {}
+        try:
+            with ThreadPoolExecutor(max_workers=codec.k) as executor:
+                while len(shards) < codec.k and candidates:
+                    needed = codec.k - len(shards)
+                    batch, candidates = candidates[:needed], candidates[needed:]
+                    reads = [
+                        (index, executor.submit(self._read_shard, path, document['name'], server, priority))
+                        for index, server in batch
+                    ]
+                    for index, future in reads:
+                        shard = future.result()
+                        if shard is not None:
+                            shards[index] = shard
+            if len(shards) < codec.k:
+                return False
+            codec.decode(shards, erasure['length'], file)
+            file.seek(0)
+            return True
+        finally:
+            for shard in shards.values():
+                shard.close()
+
+    def _read_shard(self, path: str, filename: str, server: str, priority: Priority) -> Optional[io]:
+        shard = SpooledTemporaryFile(SPOOL_SIZE)
+        try:
+            storage_server = self._connect(server, priority)
+            storage_server.read_file(path, filename, shard)
+        except ftp_errors as e:
+            logging.error(f'Failed to read shard of file {filename} on server '
+                          f'{server}: {e}')
+            shard.close()
+            return None
+        shard.seek(0)
+        return shard
 
     def delete_file(self, path: str, filename: str):
         """Delete a file with the specified path."""
-        servers = self._get_file_servers(path, filename)
+        document = self.directory_tree.get_file(path, filename)
         self.directory_tree.delete_file(path, filename)
-        for server in servers:
+        self.file_cache.invalidate(_cache_key(document))
+        if 'upload' in document:
+            self._delete_upload_file(document)
+            return
+        if not _stored_on_servers(document):
+            return  # space in pack files is reclaimed on compaction
+        self.server_registry.add_usage(document['servers'], -stored_size(document))
+
+        for server in document['servers']:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server)
                 storage_server.delete_file(path, filename)
             except ftp_errors as e:
                 logging.error(f'Failed to delete file {filename} on server '
@@ -136,26 +539,40 @@ class Storage(object):
 
     def get_file_size(self, path: str, filename: str) -> int:
         """Return the size of a file with the specified path, in bytes."""
-        servers = self._get_file_servers(path, filename)
-        for server in servers:
-            try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
-                size = storage_server.get_file_size(path, filename)
-            except ftp_errors as e:
-                logging.error(f'Failed to get size of file {filename} on server '
-                              f'{server}: {e}')
-            else:
-                return size
-        logging.error(f'Failed to get size of file {filename}')
-        return -1
+        document = self.directory_tree.lookup_file(path, filename)
+        if 'data' in document:
+            return len(document['data'])
+        if 'pack' in document:
+            return document['pack']['length']
+        if 'erasure' in document:
+            return document['erasure']['length']
+        if 'size' in document:
+            return document['size']
+
+        size = self._probe_file_size(path, filename, document['servers'])
+        if size is None:
+            logging.error(f'Failed to get size of file {filename}')
+            return -1
+        return size
 
     def copy_file(self, path: str, filename: str, new_path: str, new_filename: str = None):
         """Copy a file with the specified path to the new path."""
-        servers = self._get_file_servers(path, filename)
+        document = self.directory_tree.get_file(path, filename)
+        if 'upload' in document:
+            # parts of an upload session belong to a single file, so the copy is written anew
+            with TemporaryFile() as file:
+                if not self._read_document(path, document, file):
+                    raise NoServersAvailable(f'Failed to read file {filename} on storage servers.')
+                self.write_file(new_path, new_filename or filename, file)
+            return
         self.directory_tree.copy_file(path, filename, new_path, new_filename)
-        for server in servers:
+        if not _stored_on_servers(document):
+            return  # the file is located by the directory tree only
+        self.server_registry.add_usage(document['servers'], stored_size(document))
+
+        for server in document['servers']:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server)
                 storage_server.copy_file(path, filename, new_path, new_filename)
             except ftp_errors as e:
                 logging.error(f'Failed to copy file {filename} on server '
@@ -163,51 +580,335 @@ class Storage(object):
 
     def move_file(self, path: str, filename: str, new_path: str, new_filename: str = None):
         """Move a file with the specified path to the new path."""
-        servers = self._get_file_servers(path, filename)
+        document = self.directory_tree.get_file(path, filename)
         self.directory_tree.move_file(path, filename, new_path, new_filename)
-        for server in servers:
+        self.file_cache.invalidate(_cache_key(document))
+        if not _stored_on_servers(document):
+            return  # the file is located by the directory tree only
+
+        for server in document['servers']:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server)
                 storage_server.move_file(path, filename, new_path, new_filename)
             except ftp_errors as e:
                 logging.error(f'Failed to move file {filename} on server '
                               f'{server}: {e}')
 
+    def archive_dir(self, path: str) -> Iterator[bytes]:
+        """Generate a tar archive of the directory with the specified path."""
+        def read(name: str, document: Dict, file: io):
+            # abort the archive rather than store an empty file in it
+            if not self._read_document(posixpath.join(path, posixpath.dirname(name)), document, file,
+                                       Priority.BULK):
+                raise NoServersAvailable(f'Failed to read file {name} on storage servers.')
+
+        return write_archive(self.directory_tree.walk(path), read, ARCHIVE_READAHEAD)
+
+    def extract_archive(self, path: str, file: io):
+        """Write directories and files from a tar archive into the directory
+        with the specified path, creating missing directories."""
+        with ThreadPoolExecutor(max_workers=ARCHIVE_READAHEAD) as executor:
+            pending = deque()
+            for name, content in read_archive(file):
+                if content is None:
+                    self.directory_tree.make_dirs(posixpath.join(path, name))
+                    continue
+                dir_path = posixpath.join(path, posixpath.dirname(name))
+                self.directory_tree.make_dirs(dir_path)
+                spooled = SpooledTemporaryFile(SPOOL_SIZE)
+                shutil.copyfileobj(content, spooled)
+                spooled.seek(0)
+                pending.append(executor.submit(self._write_spooled, dir_path, posixpath.basename(name), spooled))
+                while len(pending) >= ARCHIVE_READAHEAD:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+
+    def _write_spooled(self, path: str, filename: str, file: io):
+        with file:
+            self.write_file(path, filename, file, Priority.BULK)
+
+    def locate_file(self, path: str, filename: str) -> Dict:
+        """Return servers storing the file, so that a client can read it directly.
+
+        Inline, erasure coded and uploaded in parts files can only be read through
+        the name server, so no servers are returned for them.
+        """
+        document = self.directory_tree.lookup_file(path, filename)
+        if 'data' in document or 'erasure' in document or 'upload' in document:
+            return {'servers': []}
+        location = {'servers': document['servers']}
+        if 'pack' in document:
+            location['pack'] = {
+                'id': str(document['pack']['id']),
+                'offset': document['pack']['offset'],
+                'length': document['pack']['length'],
+            }
+        return location
+
+    def allocate_file(self, path: str, filename: str, size: str) -> Dict:
+        """Choose storage servers for a file which a client writes directly.
+
+        Files which are stored inline, in pack files or erasure coded have to be
+        written through the name server, so no servers are returned for them.
+        """
+        size = int(size)
+        if size < INLINE_FILE_THRESHOLD or size < PACK_FILE_THRESHOLD or _erasure_coded(size):
+            return {'servers': []}
+        return {'servers': self._choose_storage_servers(length=size)}
+
+    def commit_file(self, path: str, filename: str, *servers: str):
+        """Record a file which a client has written directly to the servers.
+        Only registered servers which are available are accepted."""
+        servers = list(dict.fromkeys(servers))
+        if len(servers) == 0:
+            raise NoServersAvailable('No storage servers are specified.')
+        available = self._available_servers()
+        unknown = [server for server in servers if server not in available]
+        if unknown:
+            raise NoServersAvailable(f'Storage servers are not registered or not available: {", ".join(unknown)}')
+        self._replace_file(path, filename, servers, size=self._probe_file_size(path, filename, servers))
+
+    def _probe_file_size(self, path: str, filename: str, servers: List[str]) -> Optional[int]:
+        """Return the size of a file stored on the servers, or None if no server tells it."""
+        for server in servers:
+            try:
+                storage_server = self._connect(server)
+                return storage_server.get_file_size(path, filename)
+            except ftp_errors as e:
+                logging.error(f'Failed to get size of file {filename} on server '
+                              f'{server}: {e}')
+        return None
+
+    def _replace_file(self, path: str, filename: str, servers: List[str], **fields):
+        """Record a file which has been written to the servers in place of the
+        previous version of the file, then delete the previous version from
+        servers where it has not been overwritten. `fields` are the fields of
+        `DirectoryTree.create_file`. If the directory does not exist, the
+        written file is deleted."""
+        new = {key: value for key, value in fields.items() if value is not None}
+        try:
+            old = self.directory_tree.replace_file(path, filename, servers, **new)
+        except InvalidPathError:
+            # a missing directory has no previous version to keep
+            if 'pack' in new:
+                self.directory_tree.free_pack_range(new['pack'])
+            self._delete_replicas(path, filename, servers if _stored_on_servers(new) else [])
+            raise
+        self.server_registry.add_usage(servers, stored_size(new))
+
+        if old is None:
+            return
+        self.file_cache.invalidate(_cache_key(old))
+        if 'pack' in old:
+            self.directory_tree.free_pack_range(old['pack'])
+        if 'upload' in old:
+            self._delete_upload_file(old)
+            return
+        if not _stored_on_servers(old):
+            return
+        overwritten = servers if _stored_on_servers(new) else []
+        # overwritten replicas of unknown size keep their usage until reconciliation
+        kept = overwritten if 'size' not in new and 'erasure' not in new else []
+        self.server_registry.add_usage([server for server in old['servers'] if server not in kept],
+                                       -stored_size(old))
+        self._delete_replicas(path, filename, [server for server in old['servers'] if server not in overwritten])
+
+    def _delete_replicas(self, path: str, filename: str, servers: List[str]):
+        for server in servers:
+            try:
+                storage_server = self._connect(server)
+                storage_server.delete_file(path, filename)
+            except ftp_errors as e:
+                logging.error(f'Failed to delete file {filename} on server '
+                              f'{server}: {e}')
+
+    def initiate_upload(self, path: str, filename: str) -> Dict:
+        """Start an upload session of a file with the specified path.
+
+        Parts of the file are uploaded with `upload_part`, possibly in parallel
+        and more than once, and the file appears in the directory tree only
+        when the upload is completed. Uploaded files are always replicated.
+        """
+        servers = self._choose_storage_servers()
+        return {'upload': self.directory_tree.create_upload(path, filename, servers)}
+
+    def upload_part(self, upload_id: str, number: str, file: io):
+        """Write a numbered part of the upload session to its servers, replacing
+        a part with the same number."""
+        number = int(number)
+        document = self.directory_tree.get_upload(upload_id)
+        # every write gets a new name, so that a recorded part is never overwritten
+        part = {'name': f'{number}.{ObjectId()}', 'length': _file_size(file), 'servers': []}
+        for server in document['servers']:
+            try:
+                storage_server = self._connect(server)
+                storage_server.write_part(upload_id, part['name'], file)
+                part['servers'].append(server)
+            except ftp_errors as e:
+                logging.error(f'Failed to write part {number} of upload {upload_id} on server '
+                              f'{server}: {e}')
+            file.seek(0)
+        if not part['servers']:
+            raise NoServersAvailable(f'Failed to write part {number} on storage servers.')
+        self.server_registry.add_usage(part['servers'], part['length'])
+        try:
+            replaced = self.directory_tree.set_upload_part(upload_id, number, part)
+        except NoSuchUploadError:
+            self._delete_part(upload_id, part)  # completed or aborted while the part was written
+            raise
+        if replaced is not None:
+            self._delete_part(upload_id, replaced)
+
+    def get_upload_parts(self, upload_id: str) -> Dict:
+        """Return sizes of uploaded parts of the upload session by their numbers,
+        so that an interrupted upload can be resumed."""
+        parts = self.directory_tree.get_upload(upload_id)['parts']
+        return {'parts': {number: part['length'] for number, part in parts.items()}}
+
+    def complete_upload(self, upload_id: str):
+        """Record the file made of uploaded parts in the order of their numbers
+        in the directory tree.
+
+        The parts are not copied: the file is stored on the servers which have
+        all of them and is read part by part.
+        """
+        document = self.directory_tree.start_completing_upload(upload_id)
+        try:
+            parts = [part for _, part in sorted(document['parts'].items(), key=lambda item: int(item[0]))]
+            if not parts:
+                raise InvalidPathError(f'No parts are uploaded: {upload_id}')
+            servers = [server for server in document['servers']
+                       if all(server in part['servers'] for part in parts)]
+            if not servers:
+                raise NoServersAvailable(f'No storage server stores all parts of upload {upload_id}.')
+            self._replace_file(document['path'], document['filename'], servers,
+                               size=sum(part['length'] for part in parts),
+                               upload={'id': upload_id,
+                                       'parts': [{'name': part['name'], 'length': part['length']}
+                                                 for part in parts]})
+        except (InvalidPathError, NoServersAvailable):
+            # the file is not recorded, otherwise aborting the upload would delete its parts
+            self.directory_tree.stop_completing_upload(upload_id)
+            raise
+
+        self.directory_tree.delete_upload(upload_id, 'completing')
+        self._release_upload_usage(document)
+        self._delete_upload_parts(upload_id, [server for server in document['servers'] if server not in servers])
+
+    def abort_upload(self, upload_id: str):
+        """Cancel the upload session and delete its parts. An upload which is
+        being completed can not be aborted."""
+        document = self.directory_tree.start_aborting_upload(upload_id)
+        self._delete_upload_parts(upload_id, document['servers'])
+        if self.directory_tree.delete_upload(upload_id, 'aborting') is not None:
+            self._release_upload_usage(document)
+
+    def _release_upload_usage(self, document: Dict):
+        for part in document['parts'].values():
+            self.server_registry.add_usage(part['servers'], -part['length'])
+
+    def _delete_part(self, upload_id: str, part: Dict):
+        self.server_registry.add_usage(part['servers'], -part['length'])
+        for server in part['servers']:
+            try:
+                storage_server = self._connect(server, Priority.MAINTENANCE)
+                storage_server.delete_part(upload_id, part['name'])
+            except ftp_errors as e:
+                logging.error(f'Failed to delete part {part["name"]} of upload {upload_id} on server '
+                              f'{server}: {e}')
+
+    def _delete_upload_parts(self, upload_id: str, servers: List[str]):
+        for server in servers:
+            try:
+                storage_server = self._connect(server, Priority.MAINTENANCE)
+                storage_server.delete_upload(upload_id)
+            except ftp_errors as e:
+                logging.error(f'Failed to delete parts of upload {upload_id} on server '
+                              f'{server}: {e}')
+
+    def _delete_upload_file(self, document: Dict):
+        """Delete parts of a file made of an upload session from its servers."""
+        self.server_registry.add_usage(document['servers'], -stored_size(document))
+        self._delete_upload_parts(document['upload']['id'], document['servers'])
+
+    def _abort_stale_uploads_periodically(self):
+        while True:
+            time.sleep(UPLOAD_CLEANUP_INTERVAL)
+            try:
+                for upload_id in self.directory_tree.get_stale_uploads(time.time() - UPLOAD_SESSION_TIMEOUT):
+                    try:
+                        self.abort_upload(upload_id)
+                    except NoSuchUploadError:
+                        pass  # completed or aborted by another process
+            except Exception as e:
+                logging.error(f'Failed to abort abandoned upload sessions: {e}')
+
     def read_dir(self, path: str) -> List[Dict[str, str]]:
         """Return a list of files which are stored in the directory."""
         return self.directory_tree.read_dir(path)
 
+    def watch_dir(self, path: str, recursive: bool, cursor: Optional[str],
+                  timeout: float) -> Tuple[List[Dict[str, str]], str]:
+        """Wait for changes in the directory or its subtree made after the cursor,
+        return them with the cursor of the last one."""
+        return self.directory_tree.watch(path, recursive, cursor, timeout)
+
     def make_dir(self, path: str, dirname: str):
-        """Make a new directory with the specified path"""
+        """Make a new directory with the specified path.
+
+        Directories are created on storage servers only when a file is stored
+        in them.
+        """
         self.directory_tree.make_dir(path, dirname)
-        for server in self.storage_servers:
-            try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
-                storage_server.make_dir(path, dirname)
-            except ftp_errors as e:
-                logging.error(f'Failed to make directory {dirname} on server '
-                              f'{server}: {e}')
 
     def delete_dir(self, path: str, dirname: str):
         """Delete a directory with the specified path"""
+        usage = self.directory_tree.get_dir_usage(posixpath.join(path, dirname))
+        uploads = self.directory_tree.get_dir_uploads(posixpath.join(path, dirname))
         self.directory_tree.delete_dir(path, dirname)
-        for server in self.storage_servers:
+        for document in uploads:
+            self._delete_upload_file(document)
+        for server, size in usage.items():
+            self.server_registry.add_usage([server], -size)
+        for server in usage:
             try:
-                storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
+                storage_server = self._connect(server)
                 storage_server.delete_dir(path, dirname)
             except ftp_errors as e:
                 logging.error(f'Failed to delete directory {dirname} on server '
                               f'{server}: {e}')
 
-    def create_dirs(self, server: str):
-        """Create directories from the directory tree on the specified storage server."""
-        storage_server = StorageServer(server, FTP_USERNAME, FTP_PASSWORD)
-        for dir_dict in self.directory_tree.as_list():
-            try:
-                storage_server.make_dir(dir_dict['path'], dir_dict['dirname'])
-            except ftp_errors as e:
-                logging.error(f'Failed to make directory {dir_dict["dirname"]} on server '
-                              f'{server}: {e}')
+    def compact_packs(self):
+        """Rewrite sparse pack files to reclaim space of deleted files."""
+        for old_pack in self.directory_tree.seal_sparse_packs(PACK_COMPACTION_RATIO):
+            compacted = True
+            for document in self.directory_tree.get_packed_files(old_pack['_id']):
+                servers = []
+                with TemporaryFile() as file:
+                    if self._read_pack(document['servers'], document['pack'], file,
+                                       Priority.MAINTENANCE):
+                        servers, pack = self._reserve_pack_range(document['pack']['length'])
+                        servers = self._write_pack(servers, pack, file, Priority.MAINTENANCE)
+                if not servers:
+                    logging.error(f'Failed to relocate file {document["name"]} '
+                                  f'from pack {old_pack["_id"]}')
+                    compacted = False
+                    continue
+                if not self.directory_tree.set_file_pack(document['_id'], servers, pack, old_pack['_id']):
+                    self.directory_tree.free_pack_range(pack)  # the file has been replaced meanwhile
+
+            if not compacted:
+                continue
+            for server in old_pack['servers']:
+                try:
+                    storage_server = self._connect(server, Priority.MAINTENANCE)
+                    storage_server.delete_pack(str(old_pack['_id']))
+                except ftp_errors as e:
+                    logging.error(f'Failed to delete pack {old_pack["_id"]} on server '
+                                  f'{server}: {e}')
+            self.directory_tree.delete_pack(old_pack['_id'])
+            self.server_registry.add_usage(old_pack['servers'], -old_pack['size'])
 
 
 if __name__ == '__main__':
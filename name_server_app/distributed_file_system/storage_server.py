@@ -1,8 +1,11 @@
-from ftplib import FTP, all_errors
+from functools import wraps
 from io import BytesIO
 import posixpath
 from tempfile import TemporaryFile
-from typing import io, List
+from typing import io, List, Callable
+
+from .io_scheduler import IOScheduler, Priority
+from .transport import Transport, TRANSPORTS
 
 __all__ = ['StorageServer']
 
@@ -11,51 +14,115 @@ USER = 'ftpuser'
 PASSWORD = 'ftp-pass'
 
 
+def _scheduled(method):
+    """Run the method in a slot of the I/O scheduler of the server."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.scheduler is None or self._in_slot:
+            return method(self, *args, **kwargs)
+        with self.scheduler.slot(self.host, self.priority):
+            self._in_slot = True
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._in_slot = False
+    return wrapper
+
+
 class StorageServer:
     """
-    Class used as client for a FTP server on a storage.
+    Class used as client for a storage server, which transfers data over the
+    specified transport.
 
     Arguments:
         host
+        scheduler: IOScheduler - scheduler of operations on storage servers, None disables scheduling
+        priority: Priority - priority class of operations on this server
+        transport: str - 'ftp' or 'http'
     """
     STORAGE_DIR = '/'
+    PACK_DIR = '.packs'
+    UPLOAD_DIR = '.uploads'
+    STAGING_DIR = '.staging'
 
-    def __init__(self, host: str, username: str, password: str):
+    def __init__(self, host: str, username: str, password: str,
+                 scheduler: IOScheduler = None, priority: Priority = Priority.INTERACTIVE,
+                 transport: str = 'ftp'):
         self.host = host
-        self.ftp = FTP(host)
-        # self.ftp.set_pasv(False)
-        # self.ftp.set_debuglevel(1)
-        self.ftp.login(username, password)
-
-    def _change_dir(self, path):
-        path = path.lstrip('/')
-        self.ftp.cwd(posixpath.join(self.STORAGE_DIR, path))
-
+        self.scheduler = scheduler
+        self.priority = priority
+        self._in_slot = False
+        self._transport_class = TRANSPORTS[transport]
+        self._credentials = (username, password)
+        self._transport = None
+
+    @property
+    def transport(self) -> Transport:
+        """Transport to the server, which connects on first use, so that
+        connecting is done in a slot of the scheduler too."""
+        if self._transport is None:
+            self._transport = self._transport_class(self.host, *self._credentials)
+        return self._transport
+
+    def _path(self, *names: str) -> str:
+        """Return the absolute path of a file or directory on the server."""
+        return posixpath.normpath(posixpath.join(self.STORAGE_DIR, *(name.lstrip('/') for name in names)))
+
+    def _throttle(self, size: int):
+        if self.scheduler is not None:
+            self.scheduler.throttle(self.host, self.priority, size)
+
+    def _throttle_block(self, block: bytes):
+        self._throttle(len(block))
+
+    def _throttled(self, write: Callable[[bytes], None]) -> Callable[[bytes], None]:
+        """Wrap a callback receiving data, so that the data is throttled."""
+        def callback(data: bytes):
+            self._throttle(len(data))
+            write(data)
+        return callback
+
+    @_scheduled
     def create_file(self, path: str, filename: str):
         """Create an empty file with the specified path."""
-        self._change_dir(path)
-        self.ftp.storbinary(f'STOR {filename}', BytesIO())
+        self.transport.write(self._path(path, filename), BytesIO(), self._throttle_block)
 
+    @_scheduled
     def read_file(self, path: str, filename: str, file: io):
         """Read a file with the specified path."""
-        self._change_dir(path)
-        self.ftp.retrbinary(f'RETR {filename}', file.write)
+        self.transport.read(self._path(path, filename), self._throttled(file.write))
 
+    @_scheduled
     def write_file(self, path: str, filename: str, file: io):
         """Write a file with the specified path."""
-        self._change_dir(path)
-        self.ftp.storbinary(f'STOR {filename}', file)
+        self.transport.write(self._path(path, filename), file, self._throttle_block)
+
+    @_scheduled
+    def write_staged(self, name: str, file: io):
+        """Write a file under the staging name, from where `commit_staged` moves it."""
+        self.transport.write(self._path(self.STAGING_DIR, name), file, self._throttle_block)
 
+    @_scheduled
+    def commit_staged(self, name: str, path: str, filename: str):
+        """Move a staged file to the specified path, replacing the file there."""
+        self.transport.rename(self._path(self.STAGING_DIR, name), self._path(path, filename))
+
+    @_scheduled
+    def delete_staged(self, name: str):
+        """Delete a staged file."""
+        self.transport.delete(self._path(self.STAGING_DIR, name))
+
+    @_scheduled
     def delete_file(self, path: str, filename: str):
         """Delete a file with the specified path."""
-        self._change_dir(path)
-        self.ftp.delete(filename)
+        self.transport.delete(self._path(path, filename))
 
+    @_scheduled
     def get_file_size(self, path: str, filename: str) -> int:
         """Return the size of a file with the specified path, in bytes."""
-        self._change_dir(path)
-        return self.ftp.size(filename)
+        return self.transport.size(self._path(path, filename))
 
+    @_scheduled
     def copy_file(self, path: str, filename: str, new_path: str, new_filename: str = None):
         """Copy a file with the specified path to the new path."""
         new_filename = new_filename or filename
@@ -64,44 +131,66 @@ class StorageServer:
             file.seek(0)
             self.write_file(new_path, new_filename, file)
 
+    @_scheduled
     def move_file(self, path: str, filename: str, new_path: str, new_filename: str = None):
         """Move a file with the specified path to the new path."""
-        self.copy_file(path, filename, new_path, new_filename)
-        self.delete_file(path, filename)
+        new_filename = new_filename or filename
+        self.transport.rename(self._path(path, filename), self._path(new_path, new_filename))
 
+    @_scheduled
     def read_dir(self, path: str) -> List[str]:
         """Return a list of files which are stored in the directory."""
-        self._change_dir(path)
-        return list(self.ftp.nlst())
+        return self.transport.list_dir(self._path(path))
 
+    @_scheduled
     def make_dir(self, path: str, dirname: str):
         """Make a new directory with the specified path"""
-        self._change_dir(path)
-        self.ftp.mkd(dirname)
+        self.transport.make_dir(self._path(path, dirname))
 
+    @_scheduled
     def delete_dir(self, path: str, dirname: str):
         """Delete a directory with the specified path"""
-        self._delete_dir(posixpath.join(self.STORAGE_DIR, posixpath.join(path, dirname)))
-
-    def _delete_dir(self, path):
-        """Recursively delete a folder and all files in it."""
-        for name in self.ftp.nlst(path):
-            try:
-                self.ftp.cwd(name)  # it won't cause an error if it's a folder
-                self._delete_dir(posixpath.join(path, name))
-            except all_errors:
-                self.ftp.delete(posixpath.join(path, name))
-
-        self.ftp.rmd(path)
+        self.transport.delete_dir(self._path(path, dirname))
 
+    @_scheduled
     def clear(self):
         """Clear the storage."""
-        for name in self.ftp.nlst(self.STORAGE_DIR):
-            try:
-                self.ftp.cwd(name)
-                self._delete_dir(posixpath.join(self.STORAGE_DIR, name))
-            except all_errors:
-                self.ftp.delete(posixpath.join(self.STORAGE_DIR, name))
+        self.transport.clear(self.STORAGE_DIR)
+
+    @_scheduled
+    def write_pack(self, pack: str, offset: int, file: io):
+        """Write a file into the pack file starting from the specified offset."""
+        self.transport.write(self._path(self.PACK_DIR, pack), file, self._throttle_block, offset=offset)
+
+    @_scheduled
+    def read_pack(self, pack: str, offset: int, length: int, file: io):
+        """Read `length` bytes of the pack file starting from the specified offset."""
+        self.transport.read(self._path(self.PACK_DIR, pack), self._throttled(file.write), offset, length)
+
+    @_scheduled
+    def delete_pack(self, pack: str):
+        """Delete the pack file."""
+        self.transport.delete(self._path(self.PACK_DIR, pack))
+
+    @_scheduled
+    def write_part(self, upload: str, part: str, file: io):
+        """Write a part of the upload session."""
+        self.transport.write(self._path(self.UPLOAD_DIR, upload, part), file, self._throttle_block)
+
+    @_scheduled
+    def read_part(self, upload: str, part: str, file: io):
+        """Read a part of the upload session."""
+        self.transport.read(self._path(self.UPLOAD_DIR, upload, part), self._throttled(file.write))
+
+    @_scheduled
+    def delete_part(self, upload: str, part: str):
+        """Delete a part of the upload session."""
+        self.transport.delete(self._path(self.UPLOAD_DIR, upload, part))
+
+    @_scheduled
+    def delete_upload(self, upload: str):
+        """Delete parts of the upload session."""
+        self.delete_dir(self.UPLOAD_DIR, upload)
 
     def __repr__(self):
         return f'StorageServer(host={self.host})'
@@ -0,0 +1,265 @@
+from abc import ABC, abstractmethod
+from ftplib import FTP, all_errors, error_perm
+from typing import io, Callable, List
+from urllib.parse import quote
+import posixpath
+import threading
+
+import requests
+
+from name_server_proj.settings import REQUEST_TIMEOUT, STORAGE_SERVER_PORT
+
+__all__ = ['Transport', 'FtpTransport', 'HttpTransport', 'TRANSPORTS']
+
+
+class Transport(ABC):
+    """Interface of a connection to a storage server, used by StorageServer.
+
+    All paths are absolute paths on the storage server. Callbacks receive
+    blocks of data as they are transferred. Errors are raised as OSError or
+    its subclasses, like `ftplib.all_errors` and `requests.RequestException`.
+    """
+
+    @abstractmethod
+    def read(self, path: str, callback: Callable[[bytes], None], offset: int = 0, length: int = None):
+        """Read `length` bytes of a file starting from the offset, or the rest of
+        the file if `length` is None, and pass them to the callback."""
+
+    @abstractmethod
+    def write(self, path: str, file: io, callback: Callable[[bytes], None], offset: int = None,
+              append: bool = False):
+        """Write a file, creating missing directories. If `offset` is given, the
+        file is overwritten from the offset, if `append`, it is appended to."""
+
+    @abstractmethod
+    def delete(self, path: str):
+        """Delete a file."""
+
+    @abstractmethod
+    def size(self, path: str) -> int:
+        """Return the size of a file, in bytes."""
+
+    @abstractmethod
+    def rename(self, path: str, new_path: str):
+        """Move a file to the new path, creating missing directories."""
+
+    @abstractmethod
+    def list_dir(self, path: str) -> List[str]:
+        """Return names of files and directories in a directory."""
+
+    @abstractmethod
+    def make_dir(self, path: str):
+        """Make a directory."""
+
+    @abstractmethod
+    def delete_dir(self, path: str):
+        """Delete a directory with all its contents."""
+
+    @abstractmethod
+    def clear(self, path: str):
+        """Delete all contents of a directory."""
+
+
+class FtpTransport(Transport):
+    """Transport over FTP, which needs a new data connection for every transfer."""
+
+    def __init__(self, host: str, username: str, password: str):
+        self.ftp = FTP(host)
+        # self.ftp.set_pasv(False)
+        # self.ftp.set_debuglevel(1)
+        self.ftp.login(username, password)
+
+    def _make_dirs(self, path: str):
+        """Change to the directory, creating it and missing parents first."""
+        try:
+            self.ftp.cwd(path)
+        except all_errors:
+            self.ftp.cwd('/')
+            for dir_ in [dir_ for dir_ in path.split('/') if dir_]:
+                try:
+                    self.ftp.cwd(dir_)
+                except all_errors:
+                    try:
+                        self.ftp.mkd(dir_)
+                    except error_perm:
+                        pass  # made by a concurrent write, cwd fails if it is not there
+                    self.ftp.cwd(dir_)
+
+    def read(self, path: str, callback: Callable[[bytes], None], offset: int = 0, length: int = None):
+        dirname, name = posixpath.split(path)
+        self.ftp.cwd(dirname)
+        if length is None:
+            self.ftp.retrbinary(f'RETR {name}', callback, rest=offset or None)
+            return
+        if length == 0:
+            return
+        self.ftp.voidcmd('TYPE I')
+        with self.ftp.transfercmd(f'RETR {name}', rest=offset) as conn:
+            remaining = length
+            while remaining > 0:
+                data = conn.recv(min(remaining, 8192))
+                if not data:
+                    break
+                callback(data)
+                remaining -= len(data)
+        if remaining > 0:
+            raise EOFError(f'File {path} is shorter than expected')
+        try:
+            self.ftp.voidresp()
+        except all_errors:
+            pass  # the transfer is aborted when the range ends before the end of the file
+
+    def write(self, path: str, file: io, callback: Callable[[bytes], None], offset: int = None,
+              append: bool = False):
+        dirname, name = posixpath.split(path)
+        self._make_dirs(dirname)
+        command = 'APPE' if append else 'STOR'
+        self.ftp.storbinary(f'{command} {name}', file, callback=callback, rest=offset)
+
+    def delete(self, path: str):
+        dirname, name = posixpath.split(path)
+        self.ftp.cwd(dirname)
+        self.ftp.delete(name)
+
+    def size(self, path: str) -> int:
+        dirname, name = posixpath.split(path)
+        self.ftp.cwd(dirname)
+        return self.ftp.size(name)
+
+    def rename(self, path: str, new_path: str):
+        dirname, name = posixpath.split(new_path)
+        self._make_dirs(dirname)
+        self.ftp.rename(path, name)
+
+    def list_dir(self, path: str) -> List[str]:
+        self.ftp.cwd(path)
+        return list(self.ftp.nlst())
+
+    def make_dir(self, path: str):
+        dirname, name = posixpath.split(path)
+        self.ftp.cwd(dirname)
+        self.ftp.mkd(name)
+
+    def delete_dir(self, path: str):
+        for name in self.ftp.nlst(path):
+            try:
+                self.ftp.cwd(name)  # it won't cause an error if it's a folder
+                self.delete_dir(posixpath.join(path, name))
+            except all_errors:
+                self.ftp.delete(posixpath.join(path, name))
+
+        self.ftp.rmd(path)
+
+    def clear(self, path: str):
+        for name in self.ftp.nlst(path):
+            try:
+                self.ftp.cwd(name)
+                self.delete_dir(posixpath.join(path, name))
+            except all_errors:
+                self.ftp.delete(posixpath.join(path, name))
+
+
+class HttpTransport(Transport):
+    """Transport over HTTP to the service of the storage server.
+
+    Every operation is a single request with an absolute path, sent over a
+    keep-alive connection of a session, which each thread keeps per server.
+    Data is streamed, uploads use chunked transfer encoding. Storage servers
+    do not serve these requests yet, so FtpTransport stays the default. The
+    service has to serve:
+
+        GET /files/<path>                 content of a file, with Range support
+        HEAD /files/<path>                size of a file in Content-Length
+        PUT /files/<path>                 write a file, creating missing directories,
+                                          ?offset=<n> to write from the offset,
+                                          ?append=1 to append to the file
+        DELETE /files/<path>              delete a file, or a directory with its contents
+        POST /files/<path>?move=<path>    move a file, creating missing directories
+        GET /dirs/<path>                  JSON list of names in a directory
+        PUT /dirs/<path>                  make a directory
+    """
+    BLOCK_SIZE = 64 * 1024
+
+    _local = threading.local()
+
+    def __init__(self, host: str, username: str, password: str):
+        self.host = host
+        self.auth = (username, password)
+        self.base_url = f'http://{host}:{STORAGE_SERVER_PORT}'
+        self.timeout = (REQUEST_TIMEOUT, None)  # transfers of large files may take long
+
+    def _session(self) -> requests.Session:
+        sessions = self._local.__dict__.setdefault('sessions', {})
+        if self.host not in sessions:
+            session = requests.Session()
+            session.auth = self.auth
+            sessions[self.host] = session
+        return sessions[self.host]
+
+    def _request(self, method: str, resource: str, path: str, **kwargs) -> requests.Response:
+        response = self._session().request(method, f'{self.base_url}/{resource}{quote(path)}',
+                                           timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def read(self, path: str, callback: Callable[[bytes], None], offset: int = 0, length: int = None):
+        if length == 0:
+            return
+        headers = {}
+        if offset or length is not None:
+            end = '' if length is None else offset + length - 1
+            headers['Range'] = f'bytes={offset}-{end}'
+        with self._request('GET', 'files', path, headers=headers, stream=True) as response:
+            if headers and response.status_code != 206:
+                raise OSError(f'Storage server {self.host} does not support ranges of {path}')
+            received = 0
+            for data in response.iter_content(self.BLOCK_SIZE):
+                callback(data)
+                received += len(data)
+        if length is not None and received < length:
+            raise EOFError(f'File {path} is shorter than expected')
+
+    def write(self, path: str, file: io, callback: Callable[[bytes], None], offset: int = None,
+              append: bool = False):
+        def blocks():
+            while True:
+                block = file.read(self.BLOCK_SIZE)
+                if not block:
+                    break
+                callback(block)
+                yield block
+
+        params = {}
+        if offset is not None:
+            params['offset'] = offset
+        if append:
+            params['append'] = 1
+        self._request('PUT', 'files', path, params=params, data=blocks())
+
+    def delete(self, path: str):
+        self._request('DELETE', 'files', path)
+
+    def size(self, path: str) -> int:
+        return int(self._request('HEAD', 'files', path).headers['Content-Length'])
+
+    def rename(self, path: str, new_path: str):
+        self._request('POST', 'files', path, params={'move': new_path})
+
+    def list_dir(self, path: str) -> List[str]:
+        return self._request('GET', 'dirs', path).json()
+
+    def make_dir(self, path: str):
+        self._request('PUT', 'dirs', path)
+
+    def delete_dir(self, path: str):
+        self._request('DELETE', 'files', path)
+
+    def clear(self, path: str):
+        for name in self.list_dir(path):
+            self._request('DELETE', 'files', posixpath.join(path, name))
+
+
+TRANSPORTS = {
+    'ftp': FtpTransport,
+    'http': HttpTransport,
+}
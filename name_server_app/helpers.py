@@ -1,3 +1,5 @@
+from typing import Optional
+
 import requests
 
 from name_server_proj.settings import REQUEST_TIMEOUT, STORAGE_SERVER_PORT
@@ -21,9 +23,10 @@ def ping(host: str, port=STORAGE_SERVER_PORT) -> bool:
         return False
 
 
-def request_space_available(host: str, port=STORAGE_SERVER_PORT) -> int:
-    """Return how many bytes are available at storage directory."""
+def request_space_available(host: str, port=STORAGE_SERVER_PORT) -> Optional[int]:
+    """Return how many bytes are available at storage directory, or None if
+    the server did not tell."""
     try:
         return requests.get(f'http://{host}:{port}/info/space', timeout=REQUEST_TIMEOUT).json()['bytes_available']
     except Exception:
-        return 0
+        return None
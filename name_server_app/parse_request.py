@@ -14,7 +14,15 @@ operations = {
     'move': storage.move_file,
     'readdir': storage.read_dir,
     'makedir': storage.make_dir,
-    'deletedir': storage.delete_dir
+    'deletedir': storage.delete_dir,
+    'compact': storage.compact_packs,
+    'locate': storage.locate_file,
+    'allocate': storage.allocate_file,
+    'commit': storage.commit_file,
+    'upload': storage.initiate_upload,
+    'parts': storage.get_upload_parts,
+    'complete': storage.complete_upload,
+    'abort': storage.abort_upload,
 }
 
 
@@ -39,6 +47,9 @@ def parse(args, file=None):
                 print('args:', *(args[1:-1]), file)
                 storage.write_file(*(args[1:-1]), file)
                 return None
+            if op == 'part':
+                storage.upload_part(*(args[1:3]), file)
+                return None
     except InvalidPathError as e:
         return f'The query can not be executed! {e}'
     except NoServersAvailable as e:
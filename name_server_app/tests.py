@@ -1,3 +1,940 @@
-from django.test import TestCase
+from ftplib import error_perm
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from unittest import mock
+import asyncio
+import os
+import tarfile
+import time
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from pymongo import InsertOne, ReadPreference
+from pymongo.errors import BulkWriteError
+from pymongo.read_concern import ReadConcern
+import mongomock
+
+from . import parse_request
+from .views import _AsyncChunks
+from .admission import AdmissionController, Rejected, METADATA
+from .distributed_file_system import InvalidPathError, NoServersAvailable
+from .distributed_file_system import directory_tree, storage, transport
+from .distributed_file_system.archive import read_archive
+from .distributed_file_system.directory_tree import DirectoryTree, NoSuchUploadError
+from .distributed_file_system.erasure import ReedSolomon
+from .distributed_file_system.file_cache import FileCache
+from .distributed_file_system.io_scheduler import IOScheduler, Priority
+from .distributed_file_system.memory_tree import _Journal, _Write
+from .distributed_file_system.server_registry import ServerRegistry
+from .distributed_file_system.storage_server import StorageServer
+from .distributed_file_system.transport import Transport, FtpTransport, TRANSPORTS
+
+
+def _file(data: bytes) -> BytesIO:
+    return BytesIO(data)
+
+
+def _directory_tree(*args) -> DirectoryTree:
+    with mock.patch.object(directory_tree, 'MongoClient', mongomock.MongoClient):
+        tree = DirectoryTree('localhost', 'user', 'password', *args)
+    tree._changes = tree.db.changes  # mongomock has no capped collections
+    return tree
+
+
+class FakeTransport(Transport):
+    """Transport to a storage server which keeps files in a dict. Operations
+    of the server named in `failing` raise OSError, a failing write after
+    truncating the file like an interrupted FTP transfer."""
+
+    def __init__(self, host: str, files: dict, failing: set):
+        self.host = host
+        self.files = files
+        self.failing = failing
+
+    def _fail(self, operation: str):
+        if (self.host, operation) in self.failing:
+            raise OSError(f'{operation} failed on {self.host}')
+
+    def _get(self, path: str) -> bytes:
+        if path not in self.files:
+            raise OSError(f'There is no file {path} on {self.host}')
+        return self.files[path]
+
+    def read(self, path, callback, offset=0, length=None):
+        self._fail('read')
+        data = self._get(path)
+        callback(data[offset:] if length is None else data[offset:offset + length])
+
+    def write(self, path, file, callback, offset=None, append=False):
+        if (self.host, 'write') in self.failing:
+            self.files[path] = b''
+        self._fail('write')
+        data = file.read()
+        callback(data)
+        if offset is not None:
+            data = self.files.get(path, b'')[:offset].ljust(offset, b'\0') + data
+        elif append:
+            data = self.files.get(path, b'') + data
+        self.files[path] = data
+
+    def delete(self, path):
+        self._fail('delete')
+        self._get(path)
+        del self.files[path]
+
+    def size(self, path):
+        self._fail('size')
+        return len(self._get(path))
+
+    def rename(self, path, new_path):
+        self._fail('rename')
+        self.files[new_path] = self._get(path)
+        del self.files[path]
+
+    def list_dir(self, path):
+        return sorted({name[len(path):].lstrip('/').split('/')[0] for name in self.files if name.startswith(path)})
+
+    def make_dir(self, path):
+        pass
+
+    def delete_dir(self, path):
+        for name in [name for name in self.files if name.startswith(path.rstrip('/') + '/')]:
+            del self.files[name]
+
+    def clear(self, path):
+        self.files.clear()
+
+
+class FakeSession:
+    """Causally consistent session of MongoDB, which mongomock does not have."""
+
+    def __init__(self, operation_time: int):
+        self.cluster_time = {'clusterTime': operation_time}
+        self.operation_time = operation_time
+        self.advanced_to = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def advance_cluster_time(self, cluster_time):
+        self.advanced_to.append(cluster_time)
+
+    def advance_operation_time(self, operation_time):
+        self.advanced_to.append(operation_time)
+
+
+class StorageTestCase(SimpleTestCase):
+    """Storage with a directory tree in mongomock and storage servers behind FakeTransport."""
+    SERVERS = ['a', 'b', 'c']
+
+    def setUp(self):
+        self.files = {server: {} for server in self.SERVERS}
+        self.failing = set()
+        for patcher in [
+            mock.patch.dict(TRANSPORTS, {'fake': lambda host, username, password:
+                                         FakeTransport(host, self.files[host], self.failing)}),
+            mock.patch.object(storage, 'STORAGE_TRANSPORT', 'fake'),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.storage = object.__new__(storage.Storage)  # the singleton would start background threads
+        self.storage.directory_tree = _directory_tree()
+        self.storage.io_scheduler = IOScheduler(4, 2, {})
+        self.storage.server_registry = ServerRegistry(self.storage.directory_tree.db.servers, 0)
+        self.storage.file_cache = FileCache(0, 0)
+        for server in self.SERVERS:
+            self.storage.server_registry.add(server)
+            self.storage.server_registry.update(server, available=10 ** 6)
+        self.storage.directory_tree.make_dir('', 'd')
+
+    def read(self, filename: str) -> bytes:
+        file = BytesIO()
+        self.storage.read_file('d', filename, file)
+        return file.getvalue()
+
+    def servers(self, filename: str):
+        return self.storage.directory_tree.get_file('d', filename)['servers']
+
+    def staged(self):
+        return [path for files in self.files.values() for path in files if path.startswith('/.staging/')]
+
+
+class FileCacheTests(SimpleTestCase):
+    def get(self, cache: FileCache, key: str):
+        file = BytesIO()
+        return file.getvalue() if cache.get(key, file) else None
+
+    def test_get_returns_put_file(self):
+        cache = FileCache(10, 10)
+        cache.put('a', _file(b'abc'))
+        self.assertEqual(self.get(cache, 'a'), b'abc')
+        self.assertIsNone(self.get(cache, 'b'))
+
+    def test_least_recently_used_file_is_evicted(self):
+        cache = FileCache(10, 10)
+        cache.put('a', _file(b'aaaa'))
+        cache.put('b', _file(b'bbbb'))
+        self.get(cache, 'a')
+        cache.put('c', _file(b'cccc'))
+        self.assertEqual(self.get(cache, 'a'), b'aaaa')
+        self.assertIsNone(self.get(cache, 'b'))
+        self.assertEqual(self.get(cache, 'c'), b'cccc')
+        self.assertEqual(cache.memory_used, 8)
+
+    def test_eviction_without_disk_tier(self):
+        cache = FileCache(10, 10)
+        cache.put('empty', _file(b''))
+        cache.put('full', _file(b'x' * 10))
+        cache.put('small', _file(b'y'))
+        self.assertIsNone(self.get(cache, 'empty'))
+        self.assertIsNone(self.get(cache, 'full'))
+        self.assertEqual(self.get(cache, 'small'), b'y')
+        self.assertEqual(cache.memory_used, 1)
+        self.assertEqual(cache.disk_used, 0)
+
+    def test_evicted_file_is_moved_to_disk_and_back(self):
+        with TemporaryDirectory() as disk_dir:
+            cache = FileCache(10, 10, disk_dir, 100)
+            cache.put('a', _file(b'a' * 6))
+            cache.put('b', _file(b'b' * 6))
+            self.assertEqual(list(cache.disk), ['a'])
+            self.assertEqual(self.get(cache, 'a'), b'a' * 6)
+            self.assertEqual(list(cache.memory), ['a'])
+            self.assertEqual(list(cache.disk), ['b'])
+            self.assertEqual((cache.memory_used, cache.disk_used), (6, 6))
+            cache.clear()
+            self.assertEqual((cache.memory_used, cache.disk_used), (0, 0))
+
+    def test_disk_tier_evicts_least_recently_used_file(self):
+        with TemporaryDirectory() as disk_dir:
+            cache = FileCache(4, 10, disk_dir, 8)
+            for key in 'abcd':
+                cache.put(key, _file(key.encode() * 4))
+            self.assertEqual(list(cache.disk), ['b', 'c'])
+            self.assertIsNone(self.get(cache, 'a'))
+            self.assertEqual(cache.disk_used, 8)
+
+    def test_zero_length_file(self):
+        cache = FileCache(10, 10)
+        cache.put('empty', _file(b''))
+        self.assertEqual(self.get(cache, 'empty'), b'')
+        with TemporaryDirectory() as disk_dir:
+            cache = FileCache(4, 10, disk_dir, 10)
+            cache.put('empty', _file(b''))
+            cache.put('a', _file(b'aaaa'))
+            cache.put('b', _file(b'b'))
+            self.assertEqual(list(cache.disk), ['empty', 'a'])
+            self.assertEqual(self.get(cache, 'empty'), b'')
+
+    def test_oversized_file_is_not_cached(self):
+        cache = FileCache(100, 4)
+        file = _file(b'12345')
+        cache.put('a', file)
+        self.assertIsNone(self.get(cache, 'a'))
+        self.assertEqual(file.tell(), 0)
+        cache = FileCache(4, 100)
+        cache.put('a', _file(b'12345'))
+        self.assertIsNone(self.get(cache, 'a'))
+        self.assertEqual(cache.memory_used, 0)
+
+    def test_invalidate(self):
+        with TemporaryDirectory() as disk_dir:
+            cache = FileCache(4, 10, disk_dir, 10)
+            cache.put('a', _file(b'aaaa'))
+            cache.put('b', _file(b'bbbb'))
+            cache.invalidate('a')
+            cache.invalidate('b')
+            self.assertIsNone(self.get(cache, 'a'))
+            self.assertIsNone(self.get(cache, 'b'))
+            self.assertEqual((cache.memory_used, cache.disk_used), (0, 0))
+
+
+class ReedSolomonTests(SimpleTestCase):
+    def encode(self, codec: ReedSolomon, data: bytes):
+        shards = [BytesIO() for _ in range(codec.k + codec.m)]
+        codec.encode(BytesIO(data), shards)
+        return [shard.getvalue() for shard in shards]
+
+    def decode(self, codec: ReedSolomon, shards: dict, length: int) -> bytes:
+        file = BytesIO()
+        codec.decode({index: BytesIO(shard) for index, shard in shards.items()}, length, file)
+        return file.getvalue()
+
+    def test_data_shards_hold_the_data(self):
+        codec = ReedSolomon(2, 1, 4)
+        shards = self.encode(codec, b'abcdefgh12')
+        self.assertEqual(shards[0], b'abcd12\0\0')
+        self.assertEqual(shards[1], b'efgh\0\0\0\0')
+        self.assertEqual(len(shards[2]), 8)
+        self.assertEqual(self.decode(codec, {0: shards[0], 1: shards[1]}, 10), b'abcdefgh12')
+
+    def test_any_k_shards_restore_the_data(self):
+        codec = ReedSolomon(4, 2, 16)
+        data = os.urandom(1000)
+        shards = self.encode(codec, data)
+        for lost in [(0, 1), (2, 5), (0, 4), (3,)]:
+            available = {index: shard for index, shard in enumerate(shards) if index not in lost}
+            self.assertEqual(self.decode(codec, available, len(data)), data)
+
+    def test_too_many_shards(self):
+        with self.assertRaises(ValueError):
+            ReedSolomon(200, 57, 16)
+
+
+class IOSchedulerTests(SimpleTestCase):
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_waiting_operations_start_in_order_of_priority(self):
+        scheduler = IOScheduler(1, 1, {})
+        started = []
+
+        def run(priority: Priority):
+            with scheduler.slot('s', priority):
+                started.append(priority)
+
+        with scheduler.slot('s', Priority.INTERACTIVE):
+            threads = [Thread(target=run, args=(priority,))
+                       for priority in (Priority.MAINTENANCE, Priority.BULK, Priority.INTERACTIVE)]
+            for thread in threads:
+                thread.start()
+            self.wait_for(lambda: len(scheduler.nodes['s'].waiting) == 3)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(started, [Priority.INTERACTIVE, Priority.BULK, Priority.MAINTENANCE])
+
+    def test_background_operations_leave_slots_to_interactive_ones(self):
+        scheduler = IOScheduler(2, 1, {})
+        bulk_started = Event()
+
+        def run_bulk():
+            with scheduler.slot('s', Priority.BULK):
+                bulk_started.set()
+
+        with scheduler.slot('s', Priority.MAINTENANCE):
+            thread = Thread(target=run_bulk)
+            thread.start()
+            self.wait_for(lambda: scheduler.nodes['s'].waiting)
+            with scheduler.slot('s', Priority.INTERACTIVE):
+                self.assertFalse(bulk_started.is_set())
+            with scheduler.slot('other', Priority.BULK):
+                pass  # servers are scheduled separately
+        thread.join()
+        self.assertTrue(bulk_started.is_set())
+
+    def test_throttle_limits_bandwidth(self):
+        scheduler = IOScheduler(1, 1, {Priority.BULK: 10000})
+        start = time.monotonic()
+        scheduler.throttle('s', Priority.INTERACTIVE, 10 ** 9)  # no limit
+        scheduler.throttle('s', Priority.BULK, 10000)  # a burst of one second
+        self.assertLess(time.monotonic() - start, 0.1)
+        scheduler.throttle('s', Priority.BULK, 2000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+class StorageServerTests(SimpleTestCase):
+    def test_transport_connects_in_a_slot_of_the_scheduler(self):
+        scheduler = IOScheduler(1, 1, {})
+        active = []
+
+        def connect(host, username, password):
+            active.append(scheduler.nodes[host].active)
+            return FakeTransport(host, {'/f': b'data'}, set())
+
+        with mock.patch.dict(TRANSPORTS, {'fake': connect}):
+            storage_server = StorageServer('s', 'user', 'password', scheduler, Priority.BULK, 'fake')
+            self.assertEqual(active, [])
+            self.assertEqual(storage_server.get_file_size('', 'f'), 4)
+            storage_server.delete_file('', 'f')
+        self.assertEqual(active, [1])
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def test_client_limit(self):
+        controller = AdmissionController({METADATA: (10, 1)}, 10, 1)
+        controller.acquire('a', METADATA)
+        with self.assertRaises(Rejected) as raised:
+            controller.acquire('a', METADATA)
+        self.assertEqual(raised.exception.status, 429)
+        controller.acquire('b', METADATA)
+        controller.release('a', METADATA)
+        controller.acquire('a', METADATA)
+
+    def test_full_queue_and_timeout(self):
+        controller = AdmissionController({METADATA: (1, 10)}, 0, 0.05)
+        controller.acquire('a', METADATA)
+        with self.assertRaises(Rejected) as raised:
+            controller.acquire('b', METADATA)
+        self.assertEqual(raised.exception.status, 503)
+        controller = AdmissionController({METADATA: (1, 10)}, 1, 0.05)
+        controller.acquire('a', METADATA)
+        with self.assertRaises(Rejected) as raised:
+            controller.acquire('b', METADATA)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(dict(controller.budgets[METADATA].clients), {'a': 1})
+
+    def test_waiting_request_takes_released_slot(self):
+        controller = AdmissionController({METADATA: (1, 10)}, 1, 5)
+        controller.acquire('a', METADATA)
+        admitted = Event()
+
+        def wait():
+            with controller.admit('b', METADATA):
+                admitted.set()
+
+        thread = Thread(target=wait)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(admitted.is_set())
+        controller.release('a', METADATA)
+        thread.join()
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(controller.budgets[METADATA].active, 0)
+
+    def test_streaming_slot_is_released_once_on_close(self):
+        controller = AdmissionController({METADATA: (1, 10)}, 0, 0)
+        chunks = controller.admit_streaming('a', METADATA, iter([b'a', b'b']))
+        self.assertEqual(list(chunks), [b'a', b'b'])
+        self.assertEqual(controller.budgets[METADATA].active, 1)
+        chunks.close()
+        chunks.close()
+        self.assertEqual(controller.budgets[METADATA].active, 0)
+
+
+class PackRangeTests(SimpleTestCase):
+    def setUp(self):
+        self.tree = _directory_tree()
+
+    def pack(self, pack_id):
+        return self.tree.packs.find_one({'_id': pack_id})
+
+    def test_ranges_are_reserved_one_writer_at_a_time(self):
+        first = self.tree.create_pack(['a', 'b'], 10)
+        self.assertIsNone(self.tree.reserve_pack_range(['a', 'b'], 5, 100))
+        self.tree.release_pack_range(first, written=True)
+        second, servers = self.tree.reserve_pack_range(['a', 'b', 'c'], 5, 100)
+        self.assertEqual((second['id'], second['offset'], second['length']), (first['id'], 10, 5))
+        self.assertEqual(servers, ['a', 'b'])
+        self.assertIsNone(self.tree.reserve_pack_range(['a', 'b'], 5, 100))
+
+    def test_unwritten_range_is_given_back(self):
+        first = self.tree.create_pack(['a', 'b'], 10)
+        self.tree.release_pack_range(first, written=True)
+        second, _ = self.tree.reserve_pack_range(['a', 'b'], 5, 100)
+        self.tree.release_pack_range(second, written=False)
+        self.assertEqual(self.pack(first['id'])['size'], 10)
+        self.assertEqual(self.pack(first['id'])['live'], 10)
+        third, _ = self.tree.reserve_pack_range(['a', 'b'], 5, 100)
+        self.assertEqual(third['offset'], 10)
+
+    def test_packs_which_do_not_fit_are_skipped(self):
+        pack = self.tree.create_pack(['a', 'b'], 10)
+        self.tree.release_pack_range(pack, written=True)
+        self.assertIsNone(self.tree.reserve_pack_range(['a', 'b'], 91, 100))
+        self.assertIsNone(self.tree.reserve_pack_range(['a', 'c'], 5, 100))
+        self.tree.release_pack_range(pack, written=True, seal=True)
+        self.assertIsNone(self.tree.reserve_pack_range(['a', 'b'], 5, 100))
+
+    def test_lease_of_a_stopped_writer_expires(self):
+        pack = self.tree.create_pack(['a', 'b'], 10)
+        self.tree.packs.update_one({'_id': pack['id']},
+                                   {'$set': {'writing': time.time() - self.tree.PACK_WRITE_TIMEOUT - 1}})
+        self.assertEqual(self.tree.reserve_pack_range(['a', 'b'], 5, 100)[0]['offset'], 10)
+
+
+class WatchTests(SimpleTestCase):
+    def setUp(self):
+        self.tree = _directory_tree()
+        self.tree.make_dir('', 'a')
+        self.tree.make_dir('', 'abc')
+        self.tree.make_dir('abc', 'def')
+        self.cursor = self.tree.watch('', timeout=0)[1]
+
+    def watch(self, path: str, recursive: bool = False):
+        changes, _ = self.tree.watch(path, recursive, self.cursor, timeout=0)
+        return [(change['path'], change['name']) for change in changes]
+
+    def test_changes_of_the_directory_only(self):
+        self.tree.create_file('a', 'f', ['s'])
+        self.tree.create_file('abc/def', 'g', ['s'])
+        self.tree.create_file('', 'h', ['s'])
+        self.assertEqual(self.watch('a'), [('/a', 'f')])
+        self.assertEqual(self.watch(''), [('/', 'h')])
+        self.assertEqual(self.watch('abc'), [])
+
+    def test_changes_of_the_subtree(self):
+        self.tree.create_file('a', 'f', ['s'])
+        self.tree.create_file('abc/def', 'g', ['s'])
+        self.assertEqual(self.watch('abc', recursive=True), [('/abc/def', 'g')])
+        self.assertEqual(self.watch('', recursive=True), [('/a', 'f'), ('/abc/def', 'g')])
+
+    def test_cursor_returns_later_changes(self):
+        self.tree.create_file('a', 'f', ['s'])
+        changes, cursor = self.tree.watch('a', cursor=self.cursor, timeout=0)
+        self.assertEqual(len(changes), 1)
+        self.tree.create_file('abc', 'g', ['s'])
+        self.tree.create_file('a', 'h', ['s'])
+        changes, cursor = self.tree.watch('a', cursor=cursor, timeout=0)
+        self.assertEqual([change['name'] for change in changes], ['h'])
+        self.assertEqual(self.tree.watch('a', cursor=cursor, timeout=0), ([], cursor))
+
+    def test_cursor_moves_past_changes_of_other_directories(self):
+        self.tree.create_file('abc', 'g', ['s'])
+        changes, cursor = self.tree.watch('a', cursor=self.cursor, timeout=0)
+        self.assertEqual((changes, cursor), ([], str(int(self.cursor) + 1)))
+
+    def test_change_waits_for_changes_numbered_before_it(self):
+        self.tree._next_change_seq()  # numbered, but not recorded yet
+        self.tree.create_file('a', 'f', ['s'])
+        self.assertEqual(self.tree.watch('a', cursor=self.cursor, timeout=0), ([], self.cursor))
+        with mock.patch.object(self.tree, 'WATCH_GAP_TIMEOUT', -1):
+            changes, cursor = self.tree.watch('a', cursor=self.cursor, timeout=0)
+        self.assertEqual([change['name'] for change in changes], ['f'])
+        self.assertEqual(cursor, str(int(self.cursor) + 2))
+
+    def test_clear_is_reported_to_every_watch(self):
+        self.tree.clear()
+        self.tree.make_dir('', 'a')
+        self.assertEqual(self.watch('a'), [('/', '')])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidPathError):
+            self.tree.watch('a', cursor='x', timeout=0)
+        with self.assertRaises(InvalidPathError):
+            self.tree.watch('missing', timeout=0)
+
+
+class StorageWriteTests(StorageTestCase):
+    SERVERS = ['a', 'b']
+
+    def test_write_replaces_the_file(self):
+        self.storage.write_file('d', 'f', _file(b'version-1'))
+        self.storage.write_file('d', 'f', _file(b'version-2'))
+        self.assertEqual(self.read('f'), b'version-2')
+        self.assertEqual({server: files['/d/f'] for server, files in self.files.items()},
+                         {'a': b'version-2', 'b': b'version-2'})
+        self.assertEqual(self.staged(), [])
+
+    def test_failed_write_keeps_the_previous_version(self):
+        self.storage.write_file('d', 'f', _file(b'version-1'))
+        self.failing.update({('a', 'write'), ('b', 'write')})
+        with self.assertRaises(NoServersAvailable):
+            self.storage.write_file('d', 'f', _file(b'version-2'))
+        self.failing.clear()
+        self.assertEqual(self.read('f'), b'version-1')
+        self.assertEqual([files['/d/f'] for files in self.files.values()], [b'version-1', b'version-1'])
+
+    def test_file_is_recorded_on_servers_where_it_is_written(self):
+        self.storage.write_file('d', 'f', _file(b'version-1'))
+        self.failing.add(('a', 'write'))
+        self.storage.write_file('d', 'f', _file(b'version-2'))
+        self.assertEqual(self.servers('f'), ['b'])
+        self.assertEqual(self.read('f'), b'version-2')
+        self.assertNotIn('/d/f', self.files['a'])  # the previous version is deleted
+
+    def test_file_which_is_not_moved_into_place_is_deleted(self):
+        self.failing.add(('a', 'rename'))
+        self.storage.write_file('d', 'f', _file(b'data'))
+        self.assertEqual(self.servers('f'), ['b'])
+        self.assertEqual(self.staged(), [])
+
+
+class ServerRegistryTests(StorageTestCase):
+    def test_servers_are_shared_through_mongodb(self):
+        collection = self.storage.directory_tree.db.servers
+        other = ServerRegistry(collection, 60)  # of another name server process
+        self.assertEqual(other.servers(), self.SERVERS)
+        self.storage.server_registry.add('d')
+        self.assertEqual(other.servers(), self.SERVERS)
+        other.refresh()
+        self.assertEqual(other.servers(), self.SERVERS + ['d'])
+        self.assertTrue(other.get('d')['healthy'])
+
+    def test_usage_is_accounted(self):
+        registry = self.storage.server_registry
+        registry.add_usage(['a', 'b'], 100)
+        registry.add_usage(['b'], -40)
+        self.assertEqual([registry.get(server)['available'] for server in self.SERVERS],
+                         [10 ** 6 - 100, 10 ** 6 - 60, 10 ** 6])
+        registry.refresh()
+        self.assertEqual(registry.get('b')['available'], 10 ** 6 - 60)
+
+    def test_health_is_checked_once_per_interval(self):
+        self.storage.server_registry.update('a', checked=time.time() - 60)
+        with mock.patch.object(storage, 'ping', return_value=False) as ping:
+            self.assertEqual(self.storage._available_servers(), ['b', 'c'])
+            self.assertEqual(self.storage._available_servers(), ['b', 'c'])
+        ping.assert_called_once_with('a')
+        self.assertFalse(self.storage.server_registry.get('a')['healthy'])
+
+
+class LazyDirectoryTests(StorageTestCase):
+    def servers_of(self, path: str, filename: str):
+        return self.storage.directory_tree.get_file(path, filename)['servers']
+
+    def test_directories_are_made_in_the_tree_only(self):
+        with mock.patch.object(self.storage, '_connect') as connect:
+            self.storage.make_dir('d', 'x')
+        connect.assert_not_called()
+        self.assertEqual([entry['name'] for entry in self.storage.read_dir('d')], ['x'])
+
+    def test_directory_is_deleted_on_servers_storing_its_files(self):
+        self.storage.make_dir('d', 'x')
+        self.storage.make_dir('d/x', 'y')
+        self.storage.write_file('d/x/y', 'f', _file(b'data'))
+        replicas = self.servers_of('d/x/y', 'f')
+        with mock.patch.object(self.storage, '_connect', wraps=self.storage._connect) as connect:
+            self.storage.delete_dir('d', 'x')
+        self.assertCountEqual([call.args[0] for call in connect.call_args_list], replicas)
+        self.assertEqual([path for files in self.files.values() for path in files], [])
+        self.assertEqual({self.storage.server_registry.get(server)['available'] for server in self.SERVERS},
+                         {10 ** 6})
+
+
+class FtpTransportTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(transport, 'FTP')
+        self.ftp = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.made = set()
+
+        def cwd(path):
+            if path not in ('/', 'a') or path == 'a' and 'a' not in self.made:
+                raise error_perm(f'550 {path}: No such directory')
+
+        self.ftp.cwd.side_effect = cwd
+
+    def test_write_makes_missing_directories(self):
+        self.ftp.mkd.side_effect = self.made.add
+        FtpTransport('s', 'user', 'password').write('/a/f', _file(b'data'), None)
+        self.ftp.mkd.assert_called_once_with('a')
+        self.ftp.storbinary.assert_called_once()
+
+    def test_directory_made_by_a_concurrent_write_is_used(self):
+        def mkd(path):
+            self.made.add(path)  # by another connection, before this one
+            raise error_perm(f'550 {path}: File exists')
+
+        self.ftp.mkd.side_effect = mkd
+        FtpTransport('s', 'user', 'password').write('/a/f', _file(b'data'), None)
+        self.ftp.storbinary.assert_called_once()
+
+    def test_directory_which_can_not_be_made(self):
+        self.ftp.mkd.side_effect = error_perm('550 a: Permission denied')
+        with self.assertRaises(error_perm):
+            FtpTransport('s', 'user', 'password').write('/a/f', _file(b'data'), None)
+        self.ftp.storbinary.assert_not_called()
+
+
+class AllocateFileTests(StorageTestCase):
+    def test_servers_without_free_space_are_not_chosen(self):
+        self.storage.server_registry.update('a', available=100)
+        for _ in range(10):
+            self.assertCountEqual(self.storage.allocate_file('d', 'f', '1000')['servers'], ['b', 'c'])
+        self.storage.server_registry.update('b', available=100)
+        self.storage.server_registry.update('c', available=100)
+        with self.assertRaises(NoServersAvailable):
+            self.storage.allocate_file('d', 'f', '1000')
+
+
+class ErasureWriteTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in [('ERASURE_DATA_SHARDS', 2), ('ERASURE_PARITY_SHARDS', 1), ('ERASURE_FILE_THRESHOLD', 10)]:
+            patcher = mock.patch.object(storage, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.storage.write_file('d', 'f', _file(b'version'))  # replicated on two servers
+
+    def test_erasure_coded_file_replaces_replicas(self):
+        self.storage.write_file('d', 'f', _file(b'erasure coded'))
+        self.assertCountEqual(self.servers('f'), ['a', 'b', 'c'])
+        self.assertEqual(self.read('f'), b'erasure coded')
+        self.assertEqual(self.staged(), [])
+
+    def test_failed_shard_keeps_the_previous_version(self):
+        replicas = self.servers('f')
+        self.failing.add(('a', 'write'))
+        with self.assertRaises(NoServersAvailable):
+            self.storage.write_file('d', 'f', _file(b'erasure coded'))
+        self.assertEqual([self.files[server]['/d/f'] for server in replicas], [b'version', b'version'])
+        self.assertEqual(self.read('f'), b'version')
+        self.assertEqual(self.staged(), [])
+
+    def test_shard_which_is_not_moved_into_place_is_restored_from_parity(self):
+        self.failing.add(('a', 'rename'))
+        self.storage.write_file('d', 'f', _file(b'erasure coded'))
+        self.assertNotIn('/d/f', self.files['a'])
+        self.assertEqual(self.read('f'), b'erasure coded')
+        self.assertEqual(self.staged(), [])
+
+
+class ArchiveTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.storage.directory_tree.make_dirs('d/sub/empty')
+        self.storage.write_file('d', 'f', _file(b'file'))
+        self.storage.write_file('d/sub', 'g', _file(b'x' * 100000))
+
+    def archive(self) -> bytes:
+        return b''.join(self.storage.archive_dir('d'))
+
+    def test_archive_round_trip(self):
+        self.storage.extract_archive('e', BytesIO(self.archive()))
+        self.assertEqual([entry['name'] for entry in self.storage.read_dir('e')], ['sub', 'f'])
+        self.assertEqual([entry['name'] for entry in self.storage.read_dir('e/sub')], ['empty', 'g'])
+        self.assertEqual(self.read('f'), b'file')
+        file = BytesIO()
+        self.storage.read_file('e/sub', 'g', file)
+        self.assertEqual(file.getvalue(), b'x' * 100000)
+
+    def test_archive_is_aborted_if_a_file_can_not_be_read(self):
+        self.failing.update({('a', 'read'), ('b', 'read'), ('c', 'read')})
+        with self.assertRaises(NoServersAvailable):
+            self.archive()
+
+    def test_entries_outside_of_the_archive_are_kept_inside(self):
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for name in ('../up', '/absolute', 'link'):
+                info = tarfile.TarInfo(name)
+                if name == 'link':
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = '/etc/passwd'
+                tar.addfile(info, BytesIO())
+        archive.seek(0)
+        self.assertEqual([name for name, _ in read_archive(archive)], ['up', 'absolute'])
+
+
+class AsyncChunksTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = AdmissionController({METADATA: (1, 1)}, 0, 0)
+
+    def chunks(self, fail: bool):
+        yield b'a'
+        if fail:
+            raise NoServersAvailable('Failed to read file f on storage servers.')
+        yield b'b'
+
+    def collect(self, chunks) -> list:
+        async def collect():
+            return [chunk async for chunk in chunks]
+        return asyncio.run(collect())
+
+    def test_chunks_are_streamed(self):
+        chunks = _AsyncChunks(self.controller.admit_streaming('a', METADATA, self.chunks(fail=False)))
+        self.assertEqual(self.collect(chunks), [b'a', b'b'])
+        chunks.close()
+        self.assertEqual(self.controller.budgets[METADATA].active, 0)
+
+    def test_failed_read_closes_the_response(self):
+        chunks = _AsyncChunks(self.controller.admit_streaming('a', METADATA, self.chunks(fail=True)))
+        with self.assertRaises(NoServersAvailable):
+            self.collect(chunks)
+        self.assertEqual(self.controller.budgets[METADATA].active, 0)
+
+
+class UploadTests(StorageTestCase):
+    SERVERS = ['a', 'b']
+
+    def setUp(self):
+        super().setUp()
+        self.upload = self.storage.initiate_upload('d', 'f')['upload']
+
+    def parts(self, server: str):
+        return sorted(path for path in self.files[server] if path.startswith(f'/.uploads/{self.upload}/'))
+
+    def test_completed_upload_is_read_part_by_part(self):
+        self.storage.upload_part(self.upload, '2', _file(b'world'))
+        self.storage.upload_part(self.upload, '1', _file(b'hi '))
+        self.storage.upload_part(self.upload, '1', _file(b'hello '))  # the replaced part is deleted
+        self.assertEqual(self.storage.get_upload_parts(self.upload), {'parts': {'1': 6, '2': 5}})
+        self.assertEqual(len(self.parts('a')), 2)
+        self.storage.complete_upload(self.upload)
+        self.assertEqual(self.read('f'), b'hello world')
+        with self.assertRaises(NoSuchUploadError):
+            self.storage.upload_part(self.upload, '3', _file(b'!'))
+        self.assertEqual(len(self.parts('a')), 2)
+        self.storage.delete_file('d', 'f')
+        self.assertEqual(self.parts('a') + self.parts('b'), [])
+
+    def test_file_is_stored_on_servers_which_have_all_parts(self):
+        self.storage.upload_part(self.upload, '1', _file(b'hello '))
+        self.failing.add(('a', 'write'))
+        self.storage.upload_part(self.upload, '2', _file(b'world'))
+        self.storage.complete_upload(self.upload)
+        self.assertEqual(self.servers('f'), ['b'])
+        self.assertEqual(self.parts('a'), [])
+        self.assertEqual(self.read('f'), b'hello world')
+
+    def test_abort_deletes_parts(self):
+        self.storage.upload_part(self.upload, '1', _file(b'hello'))
+        self.storage.abort_upload(self.upload)
+        self.assertEqual(self.parts('a') + self.parts('b'), [])
+        with self.assertRaises(NoSuchUploadError):
+            self.storage.complete_upload(self.upload)
+        with self.assertRaises(NoSuchUploadError):
+            self.storage.upload_part(self.upload, '2', _file(b'world'))
+
+    def test_upload_being_completed_can_not_be_aborted(self):
+        self.storage.upload_part(self.upload, '1', _file(b'hello'))
+        self.storage.directory_tree.start_completing_upload(self.upload)
+        with self.assertRaises(NoSuchUploadError):
+            self.storage.abort_upload(self.upload)
+        self.assertEqual(len(self.parts('a')), 1)
+
+    def test_upload_being_aborted_can_not_be_completed(self):
+        self.storage.directory_tree.start_aborting_upload(self.upload)
+        with self.assertRaises(NoSuchUploadError):
+            self.storage.complete_upload(self.upload)
+        self.assertEqual(self.storage.directory_tree.get_stale_uploads(time.time() + 1), [self.upload])
+        self.storage.abort_upload(self.upload)  # an interrupted abort is repeated
+        with self.assertRaises(NoSuchUploadError):
+            self.storage.directory_tree.get_upload(self.upload)
+
+    def test_failed_completion_can_be_retried(self):
+        with self.assertRaises(InvalidPathError):
+            self.storage.complete_upload(self.upload)
+        self.storage.upload_part(self.upload, '1', _file(b'hello'))
+        self.storage.complete_upload(self.upload)
+        self.assertEqual(self.read('f'), b'hello')
+
+
+class ClientSessionTests(SimpleTestCase):
+    def setUp(self):
+        self.tree = _directory_tree('secondary', 2)
+        self.sessions = [FakeSession(operation_time) for operation_time in range(1, 5)]
+        patcher = mock.patch.object(self.tree.client, 'start_session', side_effect=self.sessions)
+        self.start_session = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_from_primary_need_no_session(self):
+        tree = _directory_tree()
+        with mock.patch.object(tree.client, 'start_session') as start_session:
+            with tree.client_session('a'):
+                self.assertIsNone(tree._session)
+        start_session.assert_not_called()
+
+    def test_reads_from_secondaries_use_majority_concerns(self):
+        self.assertEqual(self.tree.read_tree.read_preference, ReadPreference.SECONDARY)
+        self.assertEqual(self.tree.db.read_concern, ReadConcern('majority'))
+
+    def test_session_continues_previous_session_of_the_client(self):
+        with self.tree.client_session('a'):
+            self.assertIs(self.tree._session, self.sessions[0])
+        self.assertIsNone(self.tree._session)
+        with self.tree.client_session('a'):
+            pass
+        with self.tree.client_session('b'):
+            pass
+        self.start_session.assert_called_with(causal_consistency=True)
+        self.assertEqual(self.sessions[1].advanced_to, [{'clusterTime': 1}, 1])
+        self.assertEqual(self.sessions[2].advanced_to, [])
+
+    def test_times_of_least_recently_seen_clients_are_forgotten(self):
+        for client in ('a', 'b', 'c', 'a'):
+            with self.tree.client_session(client):
+                pass
+        self.assertEqual(self.sessions[3].advanced_to, [])
+
+    def test_lookups_are_read_in_the_session(self):
+        self.tree.create_file('', 'f', ['s'])
+        with mock.patch.object(self.tree, 'read_tree', mock.Mock(wraps=self.tree.read_tree)) as read_tree:
+            with self.tree.client_session('a'):
+                self.assertEqual(self.tree.lookup_file('', 'f')['servers'], ['s'])
+        self.assertIs(read_tree.find_one.call_args.kwargs['session'], self.sessions[0])
+
+
+class JournalTests(SimpleTestCase):
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.collection
+        self.collection.insert_one({'_id': 1})
+        self.failures = []
+        self.journal = _Journal(lambda: self.failures.append(True))
+
+    def ids(self):
+        return sorted(document['_id'] for document in self.collection.find())
+
+    def test_writes_after_a_failed_one_are_committed(self):
+        writes = [_Write(self.collection, InsertOne({'_id': id_})) for id_ in (0, 1, 2, 1, 3)]
+        self.assertEqual(_Journal._commit(writes), [writes[1], writes[3]])
+        self.assertEqual([write.error is not None for write in writes], [False, True, False, True, False])
+        self.assertIsInstance(writes[1].error, BulkWriteError)
+        self.assertEqual(self.ids(), [0, 1, 2, 3])
+
+    def test_every_write_gets_its_own_result(self):
+        writes = [self.journal.append(self.collection, InsertOne({'_id': id_})) for id_ in (0, 1, 2)]
+        self.journal.flush()
+        self.assertTrue(all(write.done.is_set() for write in writes))
+        self.assertEqual([write.error is not None for write in writes], [False, True, False])
+        self.assertEqual(self.ids(), [0, 1, 2])
+        self.assertTrue(self.failures)
+
+    def test_group_is_committed_in_one_bulk_write_per_collection(self):
+        other = self.collection.database.other
+        writes = [self.journal.append(collection, InsertOne({'_id': id_}))
+                  for collection, id_ in [(self.collection, 2), (other, 1), (self.collection, 3)]]
+        self.journal.flush()
+        self.assertEqual([write.error for write in writes], [None, None, None])
+        self.assertEqual(self.ids(), [1, 2, 3])
+        self.assertEqual([document['_id'] for document in other.find()], [1])
+        self.assertEqual(self.failures, [])
+
+    def test_other_errors_fail_all_writes(self):
+        collection = mock.Mock(name='collection')
+        collection.bulk_write.side_effect = OSError('connection lost')
+        writes = [self.journal.append(collection, InsertOne({'_id': id_})) for id_ in (5, 6)]
+        self.journal.flush()
+        self.assertEqual([str(write.error) for write in writes], ['connection lost', 'connection lost'])
+        self.assertTrue(self.failures)
+
+
+class ParseRequestTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(parse_request, 'storage')
+        self.storage = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_arguments_are_passed_to_the_operation(self):
+        copy = mock.Mock(return_value='copied')
+        with mock.patch.dict(parse_request.operations, {'copy': copy}):
+            self.assertEqual(parse_request.parse(['copy', 'dir', 'file', 'new_dir', 'new_file']), 'copied')
+        copy.assert_called_once_with('dir', 'file', 'new_dir', 'new_file')
+
+    def test_write_drops_the_size_argument(self):
+        file = BytesIO(b'data')
+        self.assertIsNone(parse_request.parse(['write', 'dir', 'file', '4'], file))
+        self.storage.write_file.assert_called_once_with('dir', 'file', file)
+
+    def test_part_gets_upload_and_number(self):
+        file = BytesIO(b'data')
+        parse_request.parse(['part', 'upload', '3'], file)
+        self.storage.upload_part.assert_called_once_with('upload', '3', file)
+
+    def test_read_returns_content(self):
+        def read_file(path, filename, file):
+            file.write(b'content')
+            file.seek(0)
+
+        self.storage.read_file.side_effect = read_file
+        self.assertEqual(parse_request.parse(['read', 'dir', 'file']), b'content')
+
+    def test_init_returns_available_space(self):
+        self.storage.get_available_space.return_value = 100
+        self.assertEqual(parse_request.parse(['init']), '100')
+        self.storage.clear.assert_called_once_with()
+
+    def test_errors_are_returned_as_messages(self):
+        failing = mock.Mock(side_effect=InvalidPathError('There is no such file: f'))
+        with mock.patch.dict(parse_request.operations, {'delete': failing}):
+            self.assertEqual(parse_request.parse(['delete', '', 'f']),
+                             'The query can not be executed! There is no such file: f')
+        self.storage.write_file.side_effect = NoServersAvailable('No storage servers are available.')
+        self.assertEqual(parse_request.parse(['write', '', 'f', '0'], BytesIO()),
+                         'The query can not be executed! No storage servers are available.')
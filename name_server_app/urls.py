@@ -4,4 +4,7 @@ from . import views
 urlpatterns = [
     path('command/', views.send_request),
     path('connect/', views.connect_storage_server),
+    path('ready/', views.ready),
+    path('archive/', views.archive),
+    path('watch/', views.watch),
 ]
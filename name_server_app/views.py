@@ -1,28 +1,57 @@
-from django.http import HttpResponse, HttpResponseNotAllowed
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from urllib import parse as urlparse
 import logging
 import sys
+import tarfile
 
 from .parse_request import parse
-from .distributed_file_system import Storage
+from .distributed_file_system import Storage, InvalidPathError, NoServersAvailable
 from .helpers import get_client_ip
+from .admission import AdmissionController, Rejected, operation_kind, METADATA, DATA, WATCH
+from name_server_proj.settings import ADMISSION_METADATA_LIMIT, ADMISSION_CLIENT_METADATA_LIMIT, \
+    ADMISSION_DATA_LIMIT, ADMISSION_CLIENT_DATA_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT, \
+    ADMISSION_WATCH_LIMIT, ADMISSION_CLIENT_WATCH_LIMIT, WATCH_TIMEOUT
 
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(levelname)s: %(message)s')
 
+admission = AdmissionController({
+    METADATA: (ADMISSION_METADATA_LIMIT, ADMISSION_CLIENT_METADATA_LIMIT),
+    DATA: (ADMISSION_DATA_LIMIT, ADMISSION_CLIENT_DATA_LIMIT),
+    WATCH: (ADMISSION_WATCH_LIMIT, ADMISSION_CLIENT_WATCH_LIMIT),
+}, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+
+
+def _parse_admitted(request, args, file=None):
+    """Execute the command once admission control lets the client in."""
+    client = get_client_ip(request)
+    with admission.admit(client, operation_kind(args[0])), Storage().client_session(client):
+        return parse(args, file)
+
+
 @csrf_exempt
 def send_request(request):
     """
     List all code snippets, or create a new snippet.
     """
+    try:
+        return _send_request(request)
+    except Rejected as e:
+        return HttpResponse(str(e), status=e.status)
+
 
+def _send_request(request):
     if request.method == 'GET':
         pyDict = dict(request.GET.lists())
         pyDict = {int(key):pyDict[key][0] for key in pyDict}
         array = [0 for i in range(len(pyDict))]
         for key, val in pyDict.items():
             array[key] = val
-        answer = parse(array)
+        answer = _parse_admitted(request, array)
+        if isinstance(answer, dict):
+            return JsonResponse(answer, status=200)
         if pyDict[0] != 'read':
             return HttpResponse(str(answer), status=200)
         else:
@@ -41,10 +70,95 @@ def send_request(request):
             array[key] = val
         print(array)
         file = request.FILES['file']
-        answer = parse(array, file)
+        answer = _parse_admitted(request, array, file)
         return HttpResponse(str(answer), status=200)
 
 
+class _AsyncChunks:
+    """
+    Asynchronous iterator over a streaming response, taking each chunk in a worker
+    thread. Under ASGI Django consumes a synchronous iterator whole before sending it.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.iterator = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await sync_to_async(next, thread_sensitive=False)(self.iterator, None)
+        except Exception:
+            # Django does not close the response when streaming fails
+            await sync_to_async(self.close, thread_sensitive=False)()
+            raise
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        self.chunks.close()
+
+
+@csrf_exempt
+def archive(request):
+    """
+    Download a directory as a tar archive, or upload a tar archive into a directory.
+    """
+    path = request.GET.get('path', '')
+    client = get_client_ip(request)
+    storage = Storage()
+    try:
+        if request.method == 'GET':
+            chunks = admission.admit_streaming(client, DATA, storage.archive_dir(path))
+            if isinstance(request, ASGIRequest):
+                chunks = _AsyncChunks(chunks)
+            response = StreamingHttpResponse(chunks, content_type='application/x-tar')
+            response['Content-Disposition'] = 'attachment; filename="archive.tar"'
+            return response
+        elif request.method == 'POST':
+            with admission.admit(client, DATA):
+                storage.extract_archive(path, request)
+            return HttpResponse('None', status=200)
+        else:
+            return HttpResponseNotAllowed(['GET', 'POST'])
+    except Rejected as e:
+        return HttpResponse(str(e), status=e.status)
+    except (InvalidPathError, NoServersAvailable, tarfile.TarError) as e:
+        return HttpResponse(f'The query can not be executed! {e}', status=200)
+
+
+def watch(request):
+    """
+    Long-poll changes in a directory or its subtree made after the cursor.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    path = request.GET.get('path', '')
+    recursive = request.GET.get('recursive', '') in ('1', 'true')
+    cursor = request.GET.get('cursor') or None
+    try:
+        timeout = min(float(request.GET.get('timeout', WATCH_TIMEOUT)), WATCH_TIMEOUT)
+    except ValueError:
+        return HttpResponse('The query can not be executed! Invalid timeout', status=400)
+    try:
+        with admission.admit(get_client_ip(request), WATCH):
+            changes, cursor = Storage().watch_dir(path, recursive, cursor, timeout)
+    except Rejected as e:
+        return HttpResponse(str(e), status=e.status)
+    except InvalidPathError as e:
+        return HttpResponse(f'The query can not be executed! {e}', status=200)
+    return JsonResponse({'changes': changes, 'cursor': cursor}, status=200)
+
+
+def ready(request):
+    """Respond with 200 if the name server is ready to serve requests, or 503 otherwise."""
+    if Storage().is_ready():
+        return HttpResponse(status=200)
+    return HttpResponse(status=503)
+
+
 def connect_storage_server(request):
     if request.method == 'GET':
         ip = request.GET.get("addr")